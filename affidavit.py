@@ -6,13 +6,39 @@
 
 import gnupg
 import os
+import hashlib
+import time
+import Queue
+import cStringIO
+import threading
+import collections
 
 class NoKeyError(Exception):
     pass
 
+def _get_keyring_mtime(homedir):
+    """ Gets the newest modification time of the keyring files """
+    mtime = 0
+    for fn in ['pubring.gpg', 'pubring.kbx', 'secring.gpg', 'private-keys-v1.d']:
+        path = os.path.join(homedir, fn)
+        if os.path.exists(path):
+            mtime = max(mtime, os.path.getmtime(path))
+    return mtime
+
+def _get_file_checksum(f):
+    """ Gets the SHA-256 hash of a file object without reading it all in """
+    csum = hashlib.sha256()
+    while True:
+        chunk = f.read(0x10000)
+        if not chunk:
+            break
+        csum.update(chunk)
+    f.seek(0)
+    return csum.hexdigest()
+
 class Affidavit(object):
     """ A quick'n'dirty signing server """
-    def __init__(self, key_uid=None, homedir='/tmp'):
+    def __init__(self, key_uid=None, homedir='/tmp', cachedir=None, max_cached=1000):
         """ Set defaults """
 
         # check exists
@@ -21,34 +47,173 @@ class Affidavit(object):
 
         # find correct key ID for the UID
         self._keyid = None
-        gpg = gnupg.GPG(gnupghome=homedir, gpgbinary='gpg2')
-        for privkey in gpg.list_keys(True):
+        self._gpg = gnupg.GPG(gnupghome=homedir, gpgbinary='gpg2')
+        for privkey in self._gpg.list_keys(True):
             for uid in privkey['uids']:
                 if uid.find(key_uid) != -1:
                     self._keyid = privkey['keyid']
         if not self._keyid:
             raise NoKeyError('No imported private key for %s' % key_uid)
+        self._key_uid = key_uid
         self._homedir = homedir
+        self._keyring_mtime = _get_keyring_mtime(homedir)
+
+        # signatures are cached using the key ID and the content hash
+        self._cachedir = None
+        self._cachedir_base = cachedir
+        self._max_cached = max_cached
+        if cachedir:
+            self._cachedir = os.path.join(cachedir, self._keyid)
+            if not os.path.exists(self._cachedir):
+                os.makedirs(self._cachedir)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache_lock = threading.Lock()
+
+        # the duration of the most recent operations, in seconds
+        self.timings = collections.deque(maxlen=100)
+
+    def is_valid_for(self, key_uid, homedir, cachedir=None):
+        """ Returns True if the UID and keyring have not changed """
+        if key_uid != self._key_uid or homedir != self._homedir:
+            return False
+        if cachedir != self._cachedir_base:
+            return False
+        if _get_keyring_mtime(homedir) != self._keyring_mtime:
+            return False
+        return True
+
+    def _add_timing(self, action, start):
+        """ Record how long an operation took """
+        self.timings.append((action, time.time() - start))
+
+    def _get_cache_filename(self, f):
+        """ Gets the cached signature filename for a file object """
+        if not self._cachedir:
+            return None
+        csum = _get_file_checksum(f)
+        return os.path.join(self._cachedir, csum + '.asc')
 
     def create(self, data):
         """ Create detached signature data """
-        gpg = gnupg.GPG(gnupghome=self._homedir, gpgbinary='gpg2')
-        return str(gpg.sign(str(data), detach=True, keyid=self._keyid))
+        return self.create_file(cStringIO.StringIO(str(data)))
+
+    def create_file(self, f):
+        """ Create detached signature data, streaming from a file object """
+
+        # we've already signed these exact bytes
+        cache_fn = self._get_cache_filename(f)
+        if cache_fn and os.path.exists(cache_fn):
+            with self._cache_lock:
+                self.cache_hits += 1
+
+            # the least recently used signatures are pruned first
+            os.utime(cache_fn, None)
+            return open(cache_fn).read()
+        with self._cache_lock:
+            self.cache_misses += 1
+
+        start = time.time()
+        sig = str(self._gpg.sign_file(f, detach=True, keyid=self._keyid))
+        self._add_timing('create', start)
+
+        # save for next time, but never a failed signature
+        if cache_fn and sig:
+            tmp_fn = '%s.%i.%i.tmp' % (cache_fn, os.getpid(),
+                                       threading.current_thread().ident)
+            with open(tmp_fn, 'w') as f:
+                f.write(sig)
+            os.rename(tmp_fn, cache_fn)
+            self._prune_cache()
+        return sig
+
+    def _prune_cache(self):
+        """ Removes the least recently used signatures over max_cached """
+        entries = []
+        for fn in os.listdir(self._cachedir):
+            if not fn.endswith('.asc'):
+                continue
+            path = os.path.join(self._cachedir, fn)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        if len(entries) <= self._max_cached:
+            return
+        entries.sort()
+        for mtime, path in entries[0:len(entries) - self._max_cached]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
     def create_detached(self, filename):
         """ Create a detached signature file """
-        data = open(filename).read()
+        with open(filename, 'rb') as f:
+            sig = self.create_file(f)
         with open(filename + '.asc', 'w') as f:
-            f.write(self.create(data))
+            f.write(sig)
+        return sig
+
+    def create_detached_many(self, filenames, max_workers=4):
+        """ Create detached signature files using several gpg processes """
+        sigs = {}
+        errors = []
+        queue = Queue.Queue()
+        for filename in filenames:
+            queue.put(filename)
+
+        def _worker():
+            while True:
+                try:
+                    filename = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    sigs[filename] = self.create_detached(filename)
+                except (IOError, OSError, ValueError, NoKeyError) as e:
+                    errors.append(e)
+
+        # wait for the slowest signature
+        threads = []
+        for _ in range(min(max_workers, len(filenames))):
+            thread = threading.Thread(target=_worker)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+        # anything unexpected has already been printed by the thread
+        if len(sigs) != len(set(filenames)):
+            raise RuntimeError('Failed to sign %i files' % (len(set(filenames)) - len(sigs)))
+        return sigs
 
     def verify(self, data):
         """ Verify that the data was signed by something we trust """
-        gpg = gnupg.GPG(gnupghome=self._homedir, gpgbinary='gpg2')
-        ver = gpg.verify(data)
+        return self.verify_file(cStringIO.StringIO(str(data)))
+
+    def verify_file(self, f):
+        """ Verify a file object was signed by something we trust """
+        start = time.time()
+        ver = self._gpg.verify_file(f)
+        self._add_timing('verify', start)
         if not ver.valid:
             raise NoKeyError('Firmware was signed with an unknown private key')
         return True
 
+_affidavit = None
+_affidavit_lock = threading.Lock()
+
+def get_affidavit(key_uid, homedir, cachedir=None):
+    """ Gets a shared affidavit, only looking up the key again if required """
+    global _affidavit
+    with _affidavit_lock:
+        if not _affidavit or not _affidavit.is_valid_for(key_uid, homedir, cachedir):
+            _affidavit = Affidavit(key_uid, homedir, cachedir)
+        return _affidavit
+
 def main():
 
     # [mine]$ gpg2 --export-secret-key > secret.key
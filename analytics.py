@@ -0,0 +1,118 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Richard Hughes <richard@hughsie.com>
+# Licensed under the GNU General Public License Version 2
+
+import os
+import json
+import time
+import datetime
+import threading
+import MySQLdb as mdb
+
+from config import ANALYTICS_TTL
+from db import LvfsDatabase, CursorError
+from db_cache import LvfsDatabaseCache
+from db_clients import LvfsDatabaseClients
+
+# the name of the copy shared with the other workers in the cache table
+ANALYTICS_CACHE_NAME = 'analytics.json'
+
+def _compute_analytics(db):
+    """ Runs all the queries needed for the analytics page """
+    db_clients = LvfsDatabaseClients(db)
+    labels, data = db_clients.get_user_agent_stats()
+    return {'date': datetime.date.today().strftime('%Y-%m-%d'),
+            'days': db_clients.get_stats_by_kind(30, 1),
+            'months': db_clients.get_metadata_by_month_by_kind(),
+            'user_agents': {'labels': labels, 'data': data},
+            'hours': db_clients.get_metadata_by_hour()}
+
+def _decode(blob):
+    """ Loads the shared copy, fixing up the integer keys JSON turned into strings """
+    data = json.loads(blob)
+    for key in ['days', 'months']:
+        data[key] = dict((int(kind), value) for kind, value in data[key].items())
+    return data
+
+class LvfsAnalyticsCache(object):
+    """
+    Keeps the analytics data for ttl seconds. Once stale the old data is
+    still returned while a background thread recalculates it, and only one
+    worker recalculates at any one time.
+    """
+
+    def __init__(self, ttl=ANALYTICS_TTL):
+        """ Constructor for object """
+        self.ttl = ttl
+        self._data = None
+        self._created = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _load_shared(self, db):
+        """ Uses the copy saved by any worker, returning True if it is fresh """
+        blob, age = LvfsDatabaseCache(db).get_data(ANALYTICS_CACHE_NAME)
+        if blob is None:
+            return False
+        data = _decode(blob)
+        if not 'date' in data:
+            return False
+        with self._lock:
+            self._data = data
+            self._created = time.time() - age
+        return age < self.ttl
+
+    def _refresh(self, db, wait):
+        """ Recalculates the data unless another worker is already doing that """
+        try:
+            cur = db.cursor()
+            cur.execute("SELECT GET_LOCK('lvfs_analytics', %s);", (wait,))
+            if not cur.fetchone()[0]:
+                return
+        except mdb.Error, e:
+            raise CursorError(cur, e)
+        try:
+            # another worker may have finished while we waited for the lock
+            if self._load_shared(db):
+                return
+            data = _compute_analytics(db)
+            LvfsDatabaseCache(db).set_data(ANALYTICS_CACHE_NAME, json.dumps(data))
+            with self._lock:
+                self._data = data
+                self._created = time.time()
+        finally:
+            cur.execute("SELECT RELEASE_LOCK('lvfs_analytics');")
+
+    def _refresh_thread(self):
+        """ The background refresh """
+        try:
+            self._refresh(LvfsDatabase(os.environ), 0)
+        except CursorError as e:
+            print 'Failed to refresh analytics: %s' % str(e)
+        finally:
+            self._refreshing = False
+
+    def get(self):
+        """ Gets the analytics data, which may be up to ttl seconds out of date """
+
+        # nothing to show yet, so everyone has to wait for the first one
+        if self._data is None:
+            db = LvfsDatabase(os.environ)
+            self._load_shared(db)
+            if self._data is None:
+                self._refresh(db, 60)
+            if self._data is None:
+                return _compute_analytics(db)
+
+        # stale-while-revalidate
+        with self._lock:
+            if time.time() - self._created >= self.ttl and not self._refreshing:
+                self._refreshing = True
+                thread = threading.Thread(target=self._refresh_thread)
+                thread.daemon = True
+                thread.start()
+            return self._data
+
+analytics_cache = LvfsAnalyticsCache()
@@ -5,12 +5,44 @@
 # Licensed under the GNU General Public License Version 2
 
 import os
+import sys
+import json
 import gzip
+import shutil
+import hashlib
 import datetime
+import MySQLdb as mdb
 
 from config import BACKUP_DIR
 from db import LvfsDatabase
 
+# these only change when files are downloaded, so are left to the weekly backup
+CHECKPOINT_IGNORE_TABLES = ['clients', 'clients_archive', 'clients_daily',
+                            'clients_hourly', 'clients_hll', 'clients_topk',
+                            'user_agents']
+
+# rows are only ever added to these, so deltas only contain the rows with
+# an ID after the marker rather than the whole table
+CHECKPOINT_APPEND_TABLES = {'event_log': 'id', 'event_log_words': 'id'}
+
+# rows in these are replaced with a new timestamp or deleted by key, so
+# deltas contain the newer rows and delete the keys that have gone
+CHECKPOINT_REPLACE_TABLES = {'cache': ('created', 'filename')}
+
+# a full checkpoint is written after this many deltas
+CHECKPOINT_MAX_DELTAS = 100
+
+def _write_dump(filename, write_cb):
+    """ Writes a compressed dump, never leaving a partial file behind """
+    try:
+        with gzip.open(filename + '.tmp', 'wb') as f:
+            write_cb(f)
+    except BaseException:
+        if os.path.exists(filename + '.tmp'):
+            os.remove(filename + '.tmp')
+        raise
+    os.rename(filename + '.tmp', filename)
+
 def _create_backup(filename, include_clients=False):
     """ Create a checkpoint """
 
@@ -22,26 +54,184 @@ def _create_backup(filename, include_clients=False):
     if os.path.exists(filename):
         return False
 
-    # save
+    # save, streaming the rows straight into the compressed file
     db = LvfsDatabase(os.environ)
-    content = db.generate_backup(include_clients)
-    with gzip.open(filename, 'wb') as f:
-        f.write(content)
+    _write_dump(filename, lambda f: db.generate_backup(f, include_clients))
     return True
 
+def _get_checkpoint_state():
+    """ Gets the tables saved by the last checkpoint, and their checksums """
+    filename = os.path.join(BACKUP_DIR, 'checkpoint.json')
+    if not os.path.exists(filename):
+        return {'base': None, 'previous': None, 'nr_deltas': 0,
+                'checksums': {}, 'markers': {}}
+    with open(filename, 'rb') as f:
+        return json.load(f)
+
+def _set_checkpoint_state(state):
+    """ Saves the state after writing a checkpoint """
+    filename = os.path.join(BACKUP_DIR, 'checkpoint.json')
+    with open(filename + '.tmp', 'wb') as f:
+        json.dump(state, f)
+    os.rename(filename + '.tmp', filename)
+
+def _get_keys_digest(db, table, column):
+    """ Gets a hash of all the keys in a table, and the keys """
+    cur = db.cursor()
+    cur.execute("SELECT `" + column + "` FROM `" + table + "` ORDER BY 1;")
+    keys = [row[0] for row in cur.fetchall()]
+    csum = hashlib.sha1()
+    for key in keys:
+        csum.update((key or u'').encode('utf-8') + '\n')
+    return csum.hexdigest(), keys
+
+def _create_checkpoint(db, now):
+    """ Writes a full or delta checkpoint if any table changed since the last one """
+
+    # the download statistics are only saved in the weekly backup
+    tables = []
+    for table in db.get_tables():
+        if not table in CHECKPOINT_IGNORE_TABLES:
+            tables.append(table)
+    state = _get_checkpoint_state()
+
+    # the markers are read in the same snapshot as the dump, so a row
+    # committed in between is either in both or in neither
+    cur = db.cursor()
+    cur.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT;")
+    try:
+        msg = _write_checkpoint(db, now, tables, state)
+    except BaseException:
+        db.discard()
+        raise
+    cur.execute("COMMIT;")
+    return msg
+
+def _write_checkpoint(db, now, tables, state):
+    """ Writes a checkpoint from inside a consistent snapshot """
+    old_markers = state.get('markers', {})
+
+    # the checksums read every row, so are only used for the small tables
+    small = []
+    for table in tables:
+        if not table in CHECKPOINT_APPEND_TABLES and not table in CHECKPOINT_REPLACE_TABLES:
+            small.append(table)
+    checksums = db.get_table_checksums(small)
+    changed = []
+    for table in small:
+        if state['checksums'].get(table) != checksums[table]:
+            changed.append(table)
+
+    # a row may be committed after one with a larger ID, so each delta starts
+    # from the largest ID seen by the checkpoint before the last one
+    markers = {}
+    appended = {}
+    for table in tables:
+        if not table in CHECKPOINT_APPEND_TABLES:
+            continue
+        column = CHECKPOINT_APPEND_TABLES[table]
+        value = db.get_max_value(table, column) or 0
+        old = old_markers.get(table)
+        if not old:
+            markers[table] = [value, value]
+            changed.append(table)
+            continue
+        markers[table] = [old[1], value]
+        if value > old[0]:
+            appended[table] = ("WHERE `" + column + "` > %s", (old[0],))
+
+    # changes within the same second as the last checkpoint are also saved again
+    deleted = {}
+    for table in tables:
+        if not table in CHECKPOINT_REPLACE_TABLES:
+            continue
+        column, key = CHECKPOINT_REPLACE_TABLES[table]
+        value = db.get_max_value(table, column)
+        if value:
+            value = value.strftime('%Y-%m-%d %H:%M:%S')
+        digest, keys = _get_keys_digest(db, table, key)
+        markers[table] = [value, digest]
+        old = old_markers.get(table)
+        if not old:
+            changed.append(table)
+            continue
+        if old[1] != digest:
+            deleted[table] = keys
+        if old[1] != digest or value != old[0]:
+            if old[0]:
+                appended[table] = ("WHERE `" + column + "` >= %s", (old[0],))
+            else:
+                appended[table] = ('', None)
+
+    dropped = []
+    for table in state['checksums'].keys() + old_markers.keys():
+        if not table in tables:
+            dropped.append(table)
+    if not changed and not appended and not dropped:
+        return None
+
+    # start again from a full dump every so often so restores stay quick
+    if not state['base'] or state['nr_deltas'] >= CHECKPOINT_MAX_DELTAS or \
+            len(old_markers) == 0:
+        basename = "restore_" + now.strftime("%Y%m%d%H%M") + ".sql.gz"
+        if os.path.exists(os.path.join(BACKUP_DIR, basename)):
+            return None
+        _write_dump(os.path.join(BACKUP_DIR, basename),
+                    lambda f: db.generate_backup(f, tables=tables, snapshot=False))
+        _set_checkpoint_state({'base': basename, 'previous': basename,
+                               'nr_deltas': 0, 'checksums': checksums,
+                               'markers': markers})
+        return 'Created restore checkpoint'
+
+    # the small tables are replaced completely, the others just get new rows
+    basename = "restore_" + now.strftime("%Y%m%d%H%M") + "_delta.sql.gz"
+    if os.path.exists(os.path.join(BACKUP_DIR, basename)):
+        return None
+    def _write_delta(f):
+        f.write("-- base: %s\n" % state['base'])
+        f.write("-- previous: %s\n\n" % state['previous'])
+        f.write("SET NAMES utf8;\n\n")
+        for table in dropped:
+            f.write("DROP TABLE IF EXISTS `" + table + "`;\n\n")
+        for table in sorted(deleted):
+            key = CHECKPOINT_REPLACE_TABLES[table][1]
+            sql = "DELETE FROM `" + table + "`"
+            keys = [k for k in deleted[table] if k is not None]
+            if keys:
+                sql += " WHERE `" + key + "` NOT IN (" + \
+                       ",".join([db.literal(k) for k in keys]) + ")"
+            f.write(sql + ";\n\n")
+        db.generate_backup(f, tables=changed, appended=appended, snapshot=False)
+    _write_dump(os.path.join(BACKUP_DIR, basename), _write_delta)
+    _set_checkpoint_state({'base': state['base'], 'previous': basename,
+                           'nr_deltas': state['nr_deltas'] + 1,
+                           'checksums': checksums, 'markers': markers})
+    return 'Created restore checkpoint'
+
 def ensure_checkpoint():
     """ Create a checkpoint """
 
-    # an empty message indicates that nothing needed to be done
-    msg = None
+    # ensure directory exists
+    if not os.path.exists(BACKUP_DIR):
+        os.mkdir(BACKUP_DIR)
 
-    # checkpointing happens up to once per minute
-    now = datetime.datetime.now()
-    filename = BACKUP_DIR + "/restore_" + now.strftime("%Y%m%d%H%M") + ".sql.gz"
-    if _create_backup(filename):
-        msg = 'Created restore checkpoint'
+    # checkpointing happens up to once per minute, and only one at a time
+    msg = None
+    db = LvfsDatabase(os.environ)
+    cur = db.cursor()
+    cur.execute("SELECT GET_LOCK('lvfs_checkpoint', 30);")
+    if cur.fetchone()[0]:
+        try:
+            msg = _create_checkpoint(db, datetime.datetime.now())
+        finally:
+            # a failed dump discards the connection, which releases the lock
+            try:
+                cur.execute("SELECT RELEASE_LOCK('lvfs_checkpoint');")
+            except mdb.Error:
+                pass
 
-    # full backups happens up to once per week
+    # full backups happens up to once per week; old clients rows are moved
+    # out by the daily retention cron job rather than in this request
     now = datetime.datetime.now()
     filename = BACKUP_DIR + "/backup_week" + now.strftime("%W") + ".sql.gz"
     if _create_backup(filename, True):
@@ -49,3 +239,41 @@ def ensure_checkpoint():
 
     # the weekly backup message is more important and overwrites the checkpoint
     return msg
+
+def _get_previous(filename):
+    """ Gets the checkpoint a delta was written after, or None for a full one """
+    with gzip.open(filename, 'rb') as f:
+        for line in f:
+            if not line.startswith('-- '):
+                break
+            if line.startswith('-- previous: '):
+                return line[13:].strip()
+    return None
+
+def rebuild_restore(filename, dest):
+    """ Joins a checkpoint and everything it depends on into one full restore """
+    chain = [filename]
+    while True:
+        previous = _get_previous(chain[0])
+        if not previous:
+            break
+        chain.insert(0, os.path.join(os.path.dirname(filename), previous))
+
+    # gzip files can simply be concatenated
+    with open(dest + '.tmp', 'wb') as out:
+        for fn in chain:
+            with open(fn, 'rb') as f:
+                shutil.copyfileobj(f, out)
+    os.rename(dest + '.tmp', dest)
+    return chain
+
+def main():
+    if len(sys.argv) != 4 or sys.argv[1] != 'rebuild':
+        print 'Usage: %s rebuild CHECKPOINT.sql.gz DEST.sql.gz' % sys.argv[0]
+        return 1
+    for fn in rebuild_restore(sys.argv[2], sys.argv[3]):
+        print 'Added %s' % fn
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
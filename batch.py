@@ -0,0 +1,146 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Richard Hughes <richard@hughsie.com>
+# Licensed under the GNU General Public License Version 2
+
+import os
+import time
+import Queue
+import atexit
+import threading
+import collections
+
+class LvfsBatchWriter(object):
+    """
+    Queues items and passes them to a callback in batches from a background
+    thread, so that the caller never has to wait for the database.
+    """
+
+    def __init__(self, write_cb, max_batch=500, max_delay=5, max_queued=10000):
+        """ Constructor for object """
+        self._write_cb = write_cb
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = Queue.Queue(max_queued)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+        # metrics
+        self.nr_queued = 0
+        self.nr_dropped = 0
+        self.nr_written = 0
+        self.nr_failed = 0
+        self.nr_batches = 0
+        self._latencies = collections.deque(maxlen=1000)
+        self._latencies_lock = threading.Lock()
+        self.latency_max = 0
+        atexit.register(self.flush)
+
+    def _ensure_thread(self):
+        """ Starts the writer thread, also after the process forked """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def add(self, item):
+        """ Queues an item, dropping it if the queue is full """
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait((time.time(), item))
+        except Queue.Full:
+            self.nr_dropped += 1
+            return False
+        self.nr_queued += 1
+        return True
+
+    def add_now(self, item):
+        """ Writes just this item from the calling thread, queueing it on failure """
+        self.nr_queued += 1
+        for _ in range(2):
+            if self._write([(time.time(), item)], count_failed=False):
+                return True
+
+        # the writer thread will try once more, or count it as failed
+        self.nr_queued -= 1
+        print 'Queueing item that could not be written now'
+        return self.add(item)
+
+    def _write(self, batch, count_failed=True):
+        """ Writes a batch of (enqueued, item), returning False on failure """
+        try:
+            self._write_cb([item for enqueued, item in batch])
+        except Exception as e:
+            # only items that are not going to be tried again count as failed
+            if count_failed:
+                self.nr_failed += len(batch)
+            print 'Failed to write batch of %i: %s' % (len(batch), str(e))
+            return False
+        now = time.time()
+        with self._latencies_lock:
+            for enqueued, item in batch:
+                latency = now - enqueued
+                self._latencies.append(latency)
+                if latency > self.latency_max:
+                    self.latency_max = latency
+        self.nr_written += len(batch)
+        self.nr_batches += 1
+        return True
+
+    def _get_batch(self):
+        """ Waits for the first item and then up to max_delay for the rest """
+        batch = [self._queue.get()]
+        deadline = time.time() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except Queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        """ The writer thread """
+        while True:
+            self._write(self._get_batch())
+
+    def flush(self):
+        """ Writes everything that is queued from the calling thread """
+        while True:
+            batch = []
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if not batch:
+                return
+            self._write(batch)
+
+    def get_stats(self):
+        """ Gets the writer metrics, with the enqueue-to-commit latency in ms """
+        with self._latencies_lock:
+            latencies = sorted(self._latencies)
+        p50 = 0
+        p95 = 0
+        if latencies:
+            p50 = latencies[len(latencies) / 2]
+            p95 = latencies[int(len(latencies) * 0.95)]
+        return {'queued': self.nr_queued,
+                'pending': self._queue.qsize(),
+                'dropped': self.nr_dropped,
+                'written': self.nr_written,
+                'failed': self.nr_failed,
+                'batches': self.nr_batches,
+                'latency_p50': round(p50 * 1000, 1),
+                'latency_p95': round(p95 * 1000, 1),
+                'latency_max': round(self.latency_max * 1000, 1)}
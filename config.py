@@ -11,14 +11,22 @@ if not 'OPENSHIFT_PYTHON_DIR' in os.environ:
     UPLOAD_DIR = 'uploads'
     DOWNLOAD_DIR = 'downloads'
     KEYRING_DIR = 'gnupg'
+    SIGCACHE_DIR = 'sigcache'
     BACKUP_DIR = 'backup'
+    ARCHIVE_DIR = 'archive'
+    LIVESTATS_FILE = 'livestats.dat'
+    EXPORT_DIR = 'export'
     CABEXTRACT_CMD = '/usr/bin/cabextract'
 else:
     STATIC_DIR = os.path.join(os.environ['OPENSHIFT_REPO_DIR'], 'static')
     UPLOAD_DIR = os.path.join(os.environ['OPENSHIFT_DATA_DIR'], 'uploads')
     DOWNLOAD_DIR = os.path.join(os.environ['OPENSHIFT_DATA_DIR'], 'downloads')
     KEYRING_DIR = os.path.join(os.environ['OPENSHIFT_DATA_DIR'], 'gnupg')
+    SIGCACHE_DIR = os.path.join(os.environ['OPENSHIFT_DATA_DIR'], 'sigcache')
     BACKUP_DIR = os.path.join(os.environ['OPENSHIFT_DATA_DIR'], 'backup')
+    ARCHIVE_DIR = os.path.join(os.environ['OPENSHIFT_DATA_DIR'], 'archive')
+    LIVESTATS_FILE = os.path.join(os.environ['OPENSHIFT_DATA_DIR'], 'livestats.dat')
+    EXPORT_DIR = os.path.join(os.environ['OPENSHIFT_DATA_DIR'], 'export')
 
     # this needs to be setup using:
     # cd app-root/data/
@@ -29,3 +37,14 @@ else:
     CABEXTRACT_CMD = os.path.join(os.environ['OPENSHIFT_DATA_DIR'],
                                   'cabextract-1.6',
                                   'cabextract')
+
+# database connections each process keeps open, and how many seconds a
+# request waits for one when they are all in use
+DB_POOL_SIZE = int(os.environ.get('LVFS_DB_POOL_SIZE', 10))
+DB_POOL_WAIT_TIMEOUT = int(os.environ.get('LVFS_DB_POOL_WAIT_TIMEOUT', 30))
+
+# raw download rows older than this are moved to ARCHIVE_DIR
+CLIENTS_RETENTION_DAYS = 90
+
+# the analytics page is recalculated at most this often, in seconds
+ANALYTICS_TTL = 3600
@@ -0,0 +1,89 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Richard Hughes <richard@hughsie.com>
+# Licensed under the GNU General Public License Version 2
+#
+# Compares loading the firmware list using one query per firmware row with
+# the single JOIN used by LvfsDatabaseFirmware.get_items().
+#
+# This adds and then removes fake firmware, so only run it on a test database.
+
+import os
+import sys
+import time
+import hashlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from db import LvfsDatabase
+from db_firmware import LvfsDatabaseFirmware, LvfsFirmware, LvfsFirmwareMd
+
+def _add_fake_firmware(db_firmware, count):
+    """ Adds fake firmware with a recognisable QA group """
+    for i in range(count):
+        fwobj = LvfsFirmware()
+        fwobj.qa_group = 'benchmark'
+        fwobj.addr = '127.0.0.1'
+        fwobj.filename = 'benchmark-%i.cab' % i
+        fwobj.fwid = hashlib.sha1('benchmark%i' % i).hexdigest()
+        fwobj.target = 'private'
+        md = LvfsFirmwareMd()
+        md.fwid = fwobj.fwid
+        md.cid = 'com.example.Benchmark%i.firmware' % i
+        md.guid = hashlib.sha1('guid%i' % i).hexdigest()[0:36]
+        md.version = str(i)
+        md.name = 'Benchmark %i' % i
+        fwobj.mds.append(md)
+        db_firmware.add(fwobj)
+
+def _remove_fake_firmware(db):
+    """ Removes all the fake firmware """
+    cur = db.cursor()
+    cur.execute("DELETE firmware_md FROM firmware_md "
+                "INNER JOIN firmware ON firmware.fwid = firmware_md.fwid "
+                "WHERE firmware.qa_group = 'benchmark';")
+    cur.execute("DELETE FROM firmware WHERE qa_group = 'benchmark';")
+
+def _get_items_per_row(db):
+    """ The old loader, with one firmware_md query for each firmware row """
+    cur = db.cursor()
+    cur.execute("SELECT fwid FROM firmware ORDER BY timestamp DESC;")
+    for e in cur.fetchall():
+        cur.execute("SELECT * FROM firmware_md WHERE fwid = %s ORDER BY guid DESC;",
+                    (e[0],))
+        cur.fetchall()
+
+def _time(func, *args):
+    """ Returns the fastest of three runs in ms """
+    best = None
+    for _ in range(3):
+        start = time.time()
+        func(*args)
+        duration = (time.time() - start) * 1000
+        if best is None or duration < best:
+            best = duration
+    return best
+
+def main():
+
+    if 'OPENSHIFT_MYSQL_DB_HOST' in os.environ:
+        print 'Refusing to add fake firmware to the production database'
+        return 1
+
+    db = LvfsDatabase(os.environ)
+    db_firmware = LvfsDatabaseFirmware(db)
+    _remove_fake_firmware(db)
+    try:
+        for count in [1000, 10000]:
+            _add_fake_firmware(db_firmware, count)
+            old = _time(_get_items_per_row, db)
+            new = _time(db_firmware.get_items)
+            print '%6i rows: per-row %8.1fms, join %8.1fms' % (count, old, new)
+            _remove_fake_firmware(db)
+    finally:
+        _remove_fake_firmware(db)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
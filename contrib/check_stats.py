@@ -0,0 +1,133 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Richard Hughes <richard@hughsie.com>
+# Licensed under the GNU General Public License Version 2
+#
+# Checks the grouped statistics queries return exactly what counting each
+# bucket of the raw download log one query at a time returns.
+#
+# Raw rows older than CLIENTS_RETENTION_DAYS are archived while the rollups
+# keep them, so buckets starting before the retention window are skipped.
+
+import os
+import sys
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from config import CLIENTS_RETENTION_DAYS
+from db import LvfsDatabase
+from db_clients import LvfsDatabaseClients, LvfsDownloadKind
+
+def _count(cur, where, args):
+    """ Count the raw rows matching a condition """
+    cur.execute("SELECT COUNT(*) FROM clients WHERE " + where, args)
+    return int(cur.fetchone()[0])
+
+def _get_first_day():
+    """ The first day that is never archived """
+    return datetime.date.today() - datetime.timedelta(CLIENTS_RETENTION_DAYS)
+
+def _get_stats_per_bucket(cur, size, interval, column, value):
+    """ The old bucketing, with one query per bucket, or None if archived """
+    data = []
+    now = datetime.date.today()
+    for i in range(size):
+        start = now - datetime.timedelta((i * interval) + interval - 1)
+        end = now - datetime.timedelta((i * interval) - 1)
+        if start < _get_first_day():
+            data.append(None)
+            continue
+        data.append(_count(cur, column + " = %s AND timestamp >= %s AND timestamp < %s",
+                           (value, start, end,)))
+    return data
+
+def _get_months_per_bucket(cur, kind):
+    """ One query for each of the last 12 calendar months, or None if archived """
+    data = []
+    now = datetime.date.today()
+    for i in range(12):
+        year = now.year
+        month = now.month - i
+        while month < 1:
+            year -= 1
+            month += 12
+        if datetime.date(year, month, 1) < _get_first_day():
+            data.append(None)
+            continue
+        data.append(_count(cur, "is_firmware = %s AND YEAR(timestamp) = %s "
+                           "AND MONTH(timestamp) = %s", (kind, year, month,)))
+    return data
+
+def _get_hours_per_bucket(cur):
+    """ One query for each hour of the day in the retention window """
+    data = []
+    for i in range(24):
+        data.append(_count(cur, "HOUR(timestamp) = %s AND timestamp >= %s",
+                           (i, _get_first_day(),)))
+    return data
+
+def _get_hours_from_rollups(cur):
+    """ The hourly rollups in the retention window """
+    cur.execute("SELECT HOUR(hour), SUM(count) FROM clients_hourly "
+                "WHERE hour >= %s GROUP BY HOUR(hour);", (_get_first_day(),))
+    data = [0] * 24
+    for hour, cnt in cur.fetchall():
+        data[hour] = int(cnt)
+    return data
+
+def _skip_archived(expected, actual):
+    """ Drops the buckets from actual that are not in expected """
+    data = []
+    for i in range(len(actual)):
+        if expected[i] is None:
+            data.append(None)
+        else:
+            data.append(actual[i])
+    return data
+
+def _check(name, expected, actual):
+    """ Prints a failure if the two series differ """
+    if expected != actual:
+        print 'FAIL %s: expected %s, got %s' % (name, expected, actual)
+        return False
+    print 'PASS %s' % name
+    return True
+
+def main():
+
+    db = LvfsDatabase(os.environ)
+    db_clients = LvfsDatabaseClients(db)
+    cur = db.cursor()
+    success = True
+
+    stats_by_kind = db_clients.get_stats_by_kind(30, 1)
+    months_by_kind = db_clients.get_metadata_by_month_by_kind()
+    for kind in LvfsDownloadKind.ALL:
+        expected = _get_stats_per_bucket(cur, 30, 1, 'is_firmware', kind)
+        success &= _check('get_stats(%i)' % kind, expected,
+                          _skip_archived(expected, db_clients.get_stats(30, 1, kind)))
+        success &= _check('get_stats_by_kind(%i)' % kind, expected,
+                          _skip_archived(expected, stats_by_kind[kind]))
+        expected = _get_months_per_bucket(cur, kind)
+        success &= _check('get_metadata_by_month(%i)' % kind, expected,
+                          _skip_archived(expected, db_clients.get_metadata_by_month(kind)))
+        success &= _check('get_metadata_by_month_by_kind(%i)' % kind, expected,
+                          _skip_archived(expected, months_by_kind[kind]))
+
+    for filename in ['firmware.xml.gz', 'firmware.xml.gz.asc']:
+        expected = _get_stats_per_bucket(cur, 12, 30, 'filename', filename)
+        success &= _check('get_stats_for_fn(%s)' % filename, expected,
+                          _skip_archived(expected, db_clients.get_stats_for_fn(12, 30, filename)))
+
+    # get_metadata_by_hour() covers every day, including the archived ones
+    success &= _check('clients_hourly',
+                      _get_hours_per_bucket(cur),
+                      _get_hours_from_rollups(cur))
+    if not success:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
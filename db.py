@@ -5,7 +5,17 @@
 # Licensed under the GNU General Public License Version 2
 
 import MySQLdb as mdb
+import MySQLdb.cursors
+import os
 import cgi
+import hashlib
+import time
+import threading
+
+from config import DB_POOL_SIZE, DB_POOL_WAIT_TIMEOUT
+
+# the largest INSERT statement written into backups, in bytes
+BACKUP_STATEMENT_SIZE = 512 * 1024
 
 class CursorError(Exception):
     def __init__(self, cur, e):
@@ -13,67 +23,308 @@ class CursorError(Exception):
     def __str__(self):
         return repr(self.value)
 
+def _connect(environ):
+    """ Opens a new connection to the database """
+    db = None
+    try:
+        if 'OPENSHIFT_MYSQL_DB_HOST' in environ:
+            db = mdb.connect(environ['OPENSHIFT_MYSQL_DB_HOST'],
+                             environ['OPENSHIFT_MYSQL_DB_USERNAME'],
+                             environ['OPENSHIFT_MYSQL_DB_PASSWORD'],
+                             'secure',
+                             int(environ['OPENSHIFT_MYSQL_DB_PORT']),
+                             use_unicode=True, charset='utf8')
+        else:
+            # mysql -u root -p
+            # CREATE DATABASE secure;
+            # CREATE USER 'test'@'localhost' IDENTIFIED BY 'test';
+            # USE secure;
+            # GRANT ALL ON secure.* TO 'test'@'localhost';
+            db = mdb.connect('localhost', 'test', 'test', 'secure',
+                             use_unicode=True, charset='utf8')
+        db.autocommit(True)
+    except mdb.Error as e:
+        print("Error %d: %s" % (e.args[0], e.args[1]))
+    return db
+
+class LvfsConnectionPool(object):
+    """ A process-wide pool of database connections """
+
+    def __init__(self, max_size=10, idle_timeout=300, ping_interval=10, wait_timeout=30):
+        """ Constructor for object """
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.ping_interval = ping_interval
+        self.wait_timeout = wait_timeout
+        self._cond = threading.Condition()
+        self._idle = []
+        self._nr_open = 0
+        self._pid = os.getpid()
+
+        # metrics
+        self.nr_checkouts = 0
+        self.nr_created = 0
+        self.nr_closed = 0
+        self.nr_waits = 0
+        self.wait_time = 0.0
+
+    def _close(self, conn):
+        """ Closes a connection, ignoring any errors """
+        self._nr_open -= 1
+        self.nr_closed += 1
+        try:
+            conn.close()
+        except mdb.Error:
+            pass
+
+    def _evict_idle(self):
+        """ Closes connections that have not been used for a while """
+        now = time.time()
+        for item in self._idle[:]:
+            if now - item[1] > self.idle_timeout:
+                self._idle.remove(item)
+                self._close(item[0])
+
+    def get(self, environ):
+        """ Checks out a connection, waiting if all are in use """
+        with self._cond:
+
+            # the parent process owns the sockets we inherited
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._idle = []
+                self._nr_open = 0
+
+            self._evict_idle()
+            self.nr_checkouts += 1
+            conn = None
+            last_used = 0
+            waited = False
+            start = time.time()
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._nr_open < self.max_size:
+                    self._nr_open += 1
+                    break
+                remaining = self.wait_timeout - (time.time() - start)
+                if remaining <= 0:
+                    raise RuntimeError('Timed out waiting for a database connection')
+                waited = True
+                self._cond.wait(remaining)
+            if waited:
+                self.nr_waits += 1
+                self.wait_time += time.time() - start
+
+        # check the connection is still alive if it has not been used recently
+        if conn and time.time() - last_used > self.ping_interval:
+            try:
+                conn.ping()
+            except mdb.Error:
+                with self._cond:
+                    self._close(conn)
+                    self._nr_open += 1
+                conn = None
+
+        # open a new connection
+        if not conn:
+            conn = _connect(environ)
+            with self._cond:
+                if not conn:
+                    self._nr_open -= 1
+                    self._cond.notify()
+                    return None
+                self.nr_created += 1
+        return conn
+
+    def put(self, conn):
+        """ Returns a connection so it can be used by someone else """
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def discard(self, conn):
+        """ Closes a checked out connection that is in an unknown state """
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._close(conn)
+            self._cond.notify()
+
+    def get_stats(self):
+        """ Gets the pool metrics """
+        with self._cond:
+            return {'open': self._nr_open,
+                    'idle': len(self._idle),
+                    'checkouts': self.nr_checkouts,
+                    'created': self.nr_created,
+                    'closed': self.nr_closed,
+                    'waits': self.nr_waits,
+                    'wait_time': self.wait_time}
+
+_pool = LvfsConnectionPool(max_size=DB_POOL_SIZE, wait_timeout=DB_POOL_WAIT_TIMEOUT)
+
+# objects created by the same thread, i.e. in the same request, share one
+# connection which is returned to the pool when the last one is destroyed
+_local = threading.local()
+
+class _LvfsSharedConnection(object):
+    def __init__(self):
+        """ Constructor for object """
+        self.conn = None
+        self.refcount = 0
+        self.is_broken = False
+
+def get_pool_stats():
+    """ Gets the metrics for the process-wide connection pool """
+    return _pool.get_stats()
+
 class LvfsDatabase(object):
 
     def __init__(self, environ):
         """ Constructor for object """
         assert environ
         self._db = None
-        try:
-            if 'OPENSHIFT_MYSQL_DB_HOST' in environ:
-                self._db = mdb.connect(environ['OPENSHIFT_MYSQL_DB_HOST'],
-                                       environ['OPENSHIFT_MYSQL_DB_USERNAME'],
-                                       environ['OPENSHIFT_MYSQL_DB_PASSWORD'],
-                                       'secure',
-                                       int(environ['OPENSHIFT_MYSQL_DB_PORT']),
-                                       use_unicode=True, charset='utf8')
-            else:
-                # mysql -u root -p
-                # CREATE DATABASE secure;
-                # CREATE USER 'test'@'localhost' IDENTIFIED BY 'test';
-                # USE secure;
-                # GRANT ALL ON secure.* TO 'test'@'localhost';
-                self._db = mdb.connect('localhost', 'test', 'test', 'secure',
-                                       use_unicode=True, charset='utf8')
-            self._db.autocommit(True)
-        except mdb.Error as e:
-            print("Error %d: %s" % (e.args[0], e.args[1]))
-        assert self._db
+        if not hasattr(_local, 'shared'):
+            _local.shared = _LvfsSharedConnection()
+        self._shared = _local.shared
+        if self._shared.refcount == 0:
+            self._shared.conn = _pool.get(environ)
+            if not self._shared.conn:
+                raise RuntimeError('Could not connect to the database')
+        self._shared.refcount += 1
+        self._db = self._shared.conn
 
     def __del__(self):
         """ Clean up the database """
-        if self._db:
-            self._db.close()
+        self.close()
+
+    def close(self):
+        """ Returns the connection to the pool when no longer used """
+        if not self._db:
+            return
+        self._db = None
+        self._shared.refcount -= 1
+        if self._shared.refcount == 0:
+            if self._shared.is_broken:
+                _pool.discard(self._shared.conn)
+            else:
+                _pool.put(self._shared.conn)
+            self._shared.conn = None
+            self._shared.is_broken = False
+
+    def discard(self):
+        """ Closes the connection rather than returning it to the pool """
+        self._shared.is_broken = True
+
+    def _dump_table(self, f, table, where='', args=None, verb='INSERT'):
+        """ Writes the rows of a table as extended INSERT statements """
+        cur = self.cursor(mdb.cursors.SSCursor)
+        cur.execute("SELECT * FROM `" + table + "` " + where + ";", args)
+        prefix = verb + " INTO `" + table + "` VALUES "
+        size = 0
+        for row in cur:
+            values = []
+            for field in row:
+                # text is unicode, so a str is from a BLOB and may not be UTF-8
+                if isinstance(field, str) and field:
+                    values.append('0x' + field.encode('hex'))
+                else:
+                    values.append(self._db.literal(field))
+            value = "(" + ",".join(values) + ")"
+
+            # keep each statement well below the default max_allowed_packet
+            if size and size + len(value) > BACKUP_STATEMENT_SIZE:
+                f.write(";\n")
+                size = 0
+            if size:
+                f.write(",\n")
+            else:
+                f.write(prefix)
+                size = len(prefix)
+            f.write(value)
+            size += len(value) + 2
+        if size:
+            f.write(";\n")
+        cur.close()
 
-    def generate_backup(self, include_clients=False):
+    def get_tables(self):
+        """ Gets the names of all the tables """
         cur = self.cursor()
         cur.execute("SHOW TABLES")
-        data = ""
         tables = []
         for table in cur.fetchall():
-            tables.append(table[0])
+            tables.append(str(table[0]))
+        return tables
 
+    def literal(self, value):
+        """ Quotes a value for use in an SQL statement """
+        return self._db.literal(value)
+
+    def get_max_value(self, table, column):
+        """ Gets the largest value of an indexed column, or None for no rows """
+        cur = self.cursor()
+        cur.execute("SELECT MAX(`" + column + "`) FROM `" + table + "`;")
+        return cur.fetchone()[0]
+
+    def get_table_checksums(self, tables):
+        """
+        Gets a checksum of the contents of each table. The rows are read
+        rather than using CHECKSUM TABLE so that they come from the current
+        snapshot, which means this is only suitable for small tables.
+        """
+        checksums = {}
+        cur = self.cursor()
         for table in tables:
+            cur.execute("SELECT * FROM `" + table + "`;")
+            digests = sorted([hashlib.sha1(repr(row)).hexdigest() for row in cur.fetchall()])
+            checksums[table] = hashlib.sha1('\n'.join(digests)).hexdigest()
+        return checksums
+
+    def generate_backup(self, f, include_clients=False, tables=None, appended=None,
+                        snapshot=True):
+        """
+        Writes an SQL dump of the database, or just some tables, to a file
+        object. The appended dict maps other tables to a (where, args) that
+        selects just some of their rows, which are written using REPLACE.
+        If snapshot is False the caller has already started the transaction.
+        """
+        cur = self.cursor()
+        if tables is None:
+            tables = self.get_tables()
+
+        # all the tables are dumped as they were at the same moment
+        if snapshot:
+            cur.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT;")
+        f.write("SET NAMES utf8;\n\n")
+        try:
+            for table in tables:
+
+                if table == 'clients' and not include_clients:
+                    continue
+
+                f.write("DROP TABLE IF EXISTS `" + table + "`;")
+                cur.execute("SHOW CREATE TABLE `" + table + "`;")
+                f.write("\n" + cur.fetchone()[1].encode('utf-8') + ";\n\n")
+                self._dump_table(f, table)
+                f.write("\n\n")
+            for table in sorted(appended or {}):
+                where, args = appended[table]
+                self._dump_table(f, table, where, args, 'REPLACE')
+                f.write("\n\n")
+        except BaseException:
+            # a streaming cursor may still have unread rows, so nothing else
+            # can be sent on this connection; closing it ends the transaction
+            self.discard()
+            raise
+        if snapshot:
+            cur.execute("COMMIT;")
 
-            if table == 'clients' and not include_clients:
-                continue
-
-            data += "DROP TABLE IF EXISTS `" + str(table) + "`;"
-            cur.execute("SHOW CREATE TABLE `" + str(table) + "`;")
-            data += "\n" + str(cur.fetchone()[1]) + ";\n\n"
-
-            cur.execute("SELECT * FROM `" + str(table) + "`;")
-            for row in cur.fetchall():
-                data += "INSERT INTO `" + str(table) + "` VALUES("
-                first = True
-                for field in row:
-                    if not first:
-                        data += ', '
-                    data += '"' + str(field) + '"'
-                    first = False
-                data += ");\n"
-            data += "\n\n"
-        return data
-
-    def cursor(self):
+    def cursor(self, cursorclass=None):
+        """ Gets a cursor, e.g. a MySQLdb.cursors.SSCursor to stream results """
+        if cursorclass:
+            return self._db.cursor(cursorclass)
         return self._db.cursor()
@@ -15,21 +15,6 @@ class LvfsDatabaseCache(object):
         """ Constructor for object """
         self._db = db
 
-        # test client table exists
-        try:
-            cur = self._db.cursor()
-            cur.execute("SELECT * FROM cache LIMIT 1;")
-        except mdb.Error as e:
-            sql_db = """
-                CREATE TABLE cache (
-                  created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  filename VARCHAR(255) DEFAULT NULL,
-                  data BLOB DEFAULT NULL,
-                  UNIQUE KEY filename (filename)
-                ) CHARSET=utf8;
-            """
-            cur.execute(sql_db)
-
     def delete(self, filename):
         """ Deletes any DB cache for the filename """
         assert filename
@@ -56,7 +41,7 @@ class LvfsDatabaseCache(object):
 
         # already exists
         if os.path.exists(filename) and not force_overwrite:
-            return
+            return True
 
         # recover from database
         basename = os.path.basename(filename)
@@ -66,7 +51,35 @@ class LvfsDatabaseCache(object):
         except mdb.Error, e:
             raise CursorError(cur, e)
         data = cur.fetchone()
-        open(filename, 'wb').write(data[0])
+        if not data:
+            return False
+        # other processes may be serving the file as soon as it exists
+        tmp = '%s.%i.tmp' % (filename, os.getpid())
+        open(tmp, 'wb').write(data[0])
+        os.rename(tmp, filename)
+        return True
+
+    def get_data(self, name):
+        """ Gets a blob and how many seconds ago it was saved, or (None, None) """
+        try:
+            cur = self._db.cursor()
+            cur.execute("SELECT data, UNIX_TIMESTAMP() - UNIX_TIMESTAMP(created) "
+                        "FROM cache WHERE filename=%s", (name,))
+        except mdb.Error, e:
+            raise CursorError(cur, e)
+        res = cur.fetchone()
+        if not res:
+            return (None, None)
+        return (res[0], int(res[1]))
+
+    def set_data(self, name, data):
+        """ Saves a blob that is not backed by a file """
+        try:
+            cur = self._db.cursor()
+            cur.execute("REPLACE INTO cache(filename,data) "
+                        "VALUES(%s,%s);", (name, data,))
+        except mdb.Error, e:
+            raise CursorError(cur, e)
 
 def main():
 
@@ -4,21 +4,262 @@
 # Copyright (C) 2015 Richard Hughes <richard@hughsie.com>
 # Licensed under the GNU General Public License Version 2
 
+import os
 import MySQLdb as mdb
+import time
+import atexit
 import hashlib
 import datetime
+import threading
 
-from db import CursorError
+from db import LvfsDatabase, CursorError
+from batch import LvfsBatchWriter
+from hyperloglog import HyperLogLog
+from topk import SpaceSaving
+
+# the file fwupd downloads when refreshing, so the user agents are clients
+USER_AGENT_FILENAME = 'firmware.xml.gz.asc'
 
 def _addr_hash(value):
     """ Generate a salted hash of the IP address """
     salt = 'addr%%%'
     return hashlib.sha1(salt + value).hexdigest()
 
+# the filename and user_agent columns are VARCHAR(256)
+MAX_COLUMN_LENGTH = 256
+
+def _truncate(value):
+    """ Cuts a value to what the database stores, so digests match the SQL ones """
+    if value is None:
+        return None
+    return value[0:MAX_COLUMN_LENGTH]
+
+def _rollup_digest(fn, user_agent):
+    """ Generate the key used to find a (filename, user_agent) rollup row """
+    value = u'%s\n%s' % (fn or u'', user_agent or u'')
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+def _get_day_range(start, end):
+    """ Gets the SQL to select whole days from start up to, but not including, end """
+    where = []
+    args = ()
+    if start:
+        where.append('timestamp >= %s')
+        args += (datetime.datetime(start.year, start.month, start.day),)
+    if end:
+        where.append('timestamp < %s')
+        args += (datetime.datetime(end.year, end.month, end.day),)
+    if not where:
+        return ('', args)
+    return ('WHERE ' + ' AND '.join(where) + ' ', args)
+
+def _rebuild_rollups(cur, start=None, end=None):
+    """ Recalculates the rollup tables from the raw download log """
+    for table, bucket in [('clients_daily', 'DATE(timestamp)'),
+                          ('clients_hourly', "DATE_FORMAT(timestamp, '%%Y-%%m-%%d %%H:00:00')")]:
+        where, args = _get_day_range(start, end)
+        cur.execute("INSERT INTO " + table + " "
+                    "SELECT " + bucket + ", is_firmware, filename, ua.user_agent, "
+                    "SHA1(CONCAT(IFNULL(filename, ''), '\\n', IFNULL(ua.user_agent, ''))), "
+                    "COUNT(*) FROM clients "
+                    "LEFT JOIN user_agents ua ON ua.id = clients.user_agent_id " + where +
+                    "GROUP BY 1, is_firmware, filename, ua.user_agent "
+                    "ON DUPLICATE KEY UPDATE count = VALUES(count);", args)
+
+def _user_agent_digest(user_agent):
+    """ Generate the key used to find an interned user agent """
+    return hashlib.sha1((u'%s' % user_agent).encode('utf-8')).hexdigest()
+
+# digest -> id, shared by all the connections in this process
+_user_agent_ids = {}
+
+def _intern_user_agents(cur, user_agents):
+    """ Gets the ids for user agents, adding any that are not already known """
+    if len(_user_agent_ids) > 10000:
+        _user_agent_ids.clear()
+    missing = {}
+    for user_agent in user_agents:
+        digest = _user_agent_digest(user_agent)
+        if not digest in _user_agent_ids:
+            missing[digest] = user_agent
+    if missing:
+        cur.executemany("INSERT IGNORE INTO user_agents (digest, user_agent) "
+                        "VALUES (%s, %s);", missing.items())
+        cur.execute("SELECT digest, id FROM user_agents WHERE digest IN (" +
+                    ', '.join(['%s'] * len(missing)) + ");", tuple(missing.keys()))
+        for digest, user_agent_id in cur.fetchall():
+            _user_agent_ids[digest] = user_agent_id
+    ids = {}
+    for user_agent in user_agents:
+        ids[user_agent] = _user_agent_ids.get(_user_agent_digest(user_agent))
+    return ids
+
+def _get_periods(timestamp):
+    """ Gets the day and month periods the user agents are counted in """
+    return [timestamp.strftime('%Y-%m-%d'), timestamp.strftime('%Y-%m')]
+
+def _save_top_user_agents(cur, summaries):
+    """ Merges top-k summaries into the ones already saved in the database """
+    cur.execute("START TRANSACTION;")
+    try:
+        for period in summaries:
+            cur.execute("SELECT data FROM clients_topk WHERE period = %s FOR UPDATE;",
+                        (period,))
+            res = cur.fetchone()
+            summary = summaries[period]
+            if res:
+                summary = SpaceSaving.from_blob(res[0])
+                summary.merge(summaries[period])
+            cur.execute("INSERT INTO clients_topk (period, data) VALUES (%s, %s) "
+                        "ON DUPLICATE KEY UPDATE data = VALUES(data);",
+                        (period, summary.to_blob(),))
+        cur.execute("COMMIT;")
+    except BaseException:
+        # e.g. a blob that cannot be decoded, which must not leave the
+        # rows locked on a pooled connection
+        cur.execute("ROLLBACK;")
+        raise
+
+def _rebuild_top_user_agents(cur, period):
+    """ Recalculates the top-k summary for a day or month from the rollups """
+    if len(period) == 7:
+        start = datetime.datetime.strptime(period, '%Y-%m').date()
+        end = (start + datetime.timedelta(32)).replace(day=1)
+    else:
+        start = datetime.datetime.strptime(period, '%Y-%m-%d').date()
+        end = start + datetime.timedelta(1)
+    cur.execute("SELECT user_agent, SUM(count) FROM clients_daily "
+                "WHERE filename = %s AND user_agent IS NOT NULL "
+                "AND day >= %s AND day < %s GROUP BY user_agent "
+                "ORDER BY SUM(count) DESC;", (USER_AGENT_FILENAME, start, end,))
+    summary = SpaceSaving()
+    for user_agent, cnt in cur.fetchall():
+        summary.add(user_agent, int(cnt))
+    cur.execute("INSERT INTO clients_topk (period, data) VALUES (%s, %s) "
+                "ON DUPLICATE KEY UPDATE data = VALUES(data);",
+                (period, summary.to_blob(),))
+
+def _add_to_sketches(sketches, day, kind, fn, addr):
+    """ Adds a hashed address to the per-kind and per-filename sketches """
+    keys = [(day, kind, '')]
+    if fn:
+        keys.append((day, kind, fn))
+    for key in keys:
+        if not key in sketches:
+            sketches[key] = HyperLogLog()
+        sketches[key].add(addr)
+
+def _save_sketches(cur, sketches):
+    """
+    Merges sketches into the ones already saved in the database, which has
+    to be done inside a transaction so the rows stay locked until written
+    """
+    for key in sketches:
+        cur.execute("SELECT sketch FROM clients_hll WHERE day = %s "
+                    "AND is_firmware = %s AND filename = %s FOR UPDATE;", key)
+        res = cur.fetchone()
+        if res:
+            sketches[key].merge(HyperLogLog.from_blob(res[0]))
+        cur.execute("INSERT INTO clients_hll (day, is_firmware, filename, sketch) "
+                    "VALUES (%s, %s, %s, %s) "
+                    "ON DUPLICATE KEY UPDATE sketch = VALUES(sketch);",
+                    key + (sketches[key].to_blob(),))
+
+def _rebuild_sketches(cur, start=None, end=None):
+    """ Recalculates the unique address sketches from the raw download log """
+    where, args = _get_day_range(start, end)
+    cur.execute("SELECT DISTINCT DATE(timestamp) FROM clients " + where + ";", args)
+
+    # do this one day at a time so we never load the entire table
+    for day in [e[0] for e in cur.fetchall()]:
+        cur.execute("SELECT is_firmware, filename, addr FROM clients "
+                    "WHERE timestamp >= %s AND timestamp < %s;",
+                    (day, day + datetime.timedelta(1),))
+        sketches = {}
+        for kind, fn, addr in cur.fetchall():
+            _add_to_sketches(sketches, day, kind, fn, addr)
+        rows = []
+        for key in sketches:
+            rows.append(key + (sketches[key].to_blob(),))
+        cur.executemany("INSERT INTO clients_hll (day, is_firmware, filename, sketch) "
+                        "VALUES (%s, %s, %s, %s) "
+                        "ON DUPLICATE KEY UPDATE sketch = VALUES(sketch);", rows)
+
+def _bucket_days(res, size, interval):
+    """ Adds (day, count) rows into buckets of interval days, newest first """
+    data = [0] * size
+    now = datetime.date.today()
+    for day, cnt in res:
+        i = (now - day).days / interval
+        if i >= 0 and i < size:
+            data[i] += int(cnt)
+    return data
+
+def _get_month_start(now):
+    """ Gets the first day of the month 11 months before now """
+    year = now.year
+    month = now.month - 11
+    if month < 1:
+        year -= 1
+        month += 12
+    return datetime.date(year, month, 1)
+
+def _bucket_months(res, now):
+    """ Adds (year, month, count) rows into the last 12 months, newest first """
+    data = [0] * 12
+    for year, month, cnt in res:
+        i = (now.year - year) * 12 + now.month - month
+        if i >= 0 and i < 12:
+            data[i] += int(cnt)
+    return data
+
+class LvfsUserAgentTracker(object):
+    """
+    Counts the most common user agents for each day and month in memory,
+    merging the counts into the database every checkpoint_interval seconds.
+    """
+
+    def __init__(self, checkpoint_interval=60):
+        """ Constructor for object """
+        self.checkpoint_interval = checkpoint_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last_checkpoint = time.time()
+
+    def add(self, timestamp, user_agent):
+        """ Counts a user agent """
+        with self._lock:
+            for period in _get_periods(timestamp):
+                if not period in self._pending:
+                    self._pending[period] = SpaceSaving()
+                self._pending[period].add(user_agent)
+
+    def get_pending(self, period):
+        """ Gets the counts not yet saved to the database """
+        summary = SpaceSaving()
+        with self._lock:
+            if period in self._pending:
+                summary.merge(self._pending[period])
+        return summary
+
+    def checkpoint(self, cur, force=False):
+        """ Saves the pending counts if the interval has passed """
+        if not force and time.time() - self._last_checkpoint < self.checkpoint_interval:
+            return
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._last_checkpoint = time.time()
+        if pending:
+            _save_top_user_agents(cur, pending)
+
+user_agent_tracker = LvfsUserAgentTracker()
+
 class LvfsDownloadKind(object):
     METADATA = 0
     FIRMWARE = 1
     SIGNING = 2
+    ALL = [METADATA, FIRMWARE, SIGNING]
 
 class LvfsDatabaseClients(object):
 
@@ -26,144 +267,306 @@ class LvfsDatabaseClients(object):
         """ Constructor for object """
         self._db = db
 
-        # test client table exists
+    def _count_unique(self, where, args, start=None, end=None):
+        """ Estimates the unique addresses by merging the matching sketches """
+        if start:
+            where += " AND day >= %s"
+            args += (start,)
+        if end:
+            where += " AND day <= %s"
+            args += (end,)
         try:
             cur = self._db.cursor()
-            cur.execute("SELECT * FROM clients LIMIT 1;")
-        except mdb.Error, e:
-            sql_db = """
-                CREATE TABLE clients (
-                  id INT NOT NULL AUTO_INCREMENT,
-                  timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  addr VARCHAR(40) DEFAULT NULL,
-                  is_firmware TINYINT DEFAULT 0,
-                  filename VARCHAR(256) DEFAULT NULL,
-                  user_agent VARCHAR(256) DEFAULT NULL,
-                  UNIQUE KEY id (id)
-                ) CHARSET=utf8;
-            """
-            cur.execute(sql_db)
-
-    def get_firmware_count_unique(self, kind):
-        """ get the number of files we've provided """
-        try:
-            cur = self._db.cursor()
-            cur.execute("SELECT DISTINCT(COUNT(addr)) FROM clients "
-                        "WHERE is_firmware = %s", (kind,))
+            cur.execute("SELECT sketch FROM clients_hll WHERE " + where + ";", args)
         except mdb.Error, e:
             raise CursorError(cur, e)
-        user_cnt = cur.fetchone()[0]
-        if not user_cnt:
-            return 0
-        return user_cnt
+        hll = HyperLogLog()
+        for e in cur.fetchall():
+            hll.merge(HyperLogLog.from_blob(e[0]))
+        return hll.count()
+
+    def get_firmware_count_unique(self, kind, start=None, end=None):
+        """ get the approximate number of unique clients for a kind """
+        return self._count_unique("is_firmware = %s AND filename = ''",
+                                  (kind,), start, end)
 
-    def get_firmware_count_filename(self, filename):
-        """ get the number of files we've provided """
+    def get_firmware_downloads(self, filename):
+        """ get the exact number of times a file has been downloaded """
         try:
             cur = self._db.cursor()
-            cur.execute("SELECT DISTINCT(COUNT(addr)) FROM clients "
-                        "WHERE filename = %s", (filename,))
+            cur.execute("SELECT SUM(count) FROM clients_daily "
+                        "WHERE filename = %s;", (filename,))
         except mdb.Error, e:
             raise CursorError(cur, e)
-        user_cnt = cur.fetchone()[0]
-        if not user_cnt:
+        res = cur.fetchone()[0]
+        if not res:
             return 0
-        return user_cnt
+        return int(res)
+
+    def get_firmware_count_filename(self, filename, start=None, end=None):
+        """ get the approximate number of unique clients for a file """
+        return self._count_unique("filename = %s", (filename,), start, end)
 
-    def get_user_agent_stats(self):
-        """ Gets the number of user agents """
+    def get_user_agent_stats(self, period=None, limit=6):
+        """ Gets the most common user agents for a day or month """
+        if not period:
+            period = datetime.date.today().strftime('%Y-%m')
         try:
             cur = self._db.cursor()
-            cur.execute("SELECT user_agent, COUNT(*) AS count FROM clients "
-                        "WHERE user_agent IS NOT NULL AND filename = 'firmware.xml.gz.asc' "
-                        "GROUP BY user_agent ORDER BY COUNT(*) DESC LIMIT 6;")
+            cur.execute("SELECT data FROM clients_topk WHERE period = %s;", (period,))
         except mdb.Error, e:
             raise CursorError(cur, e)
-        res = cur.fetchall()
+        summary = user_agent_tracker.get_pending(period)
+        res = cur.fetchone()
+        if res:
+            summary.merge(SpaceSaving.from_blob(res[0]))
+        res = summary.top(limit)
         if not res:
             return (["No data"],[0])
         labels = []
         data = []
         for e in res:
             labels.append(e[0])
-            data.append(e[1])
+            data.append(long(e[1]))
         return (labels, data)
 
+    def rebuild_top_user_agents(self, period):
+        """ Recalculates the most common user agents for a day or month """
+        try:
+            cur = self._db.cursor()
+            _rebuild_top_user_agents(cur, period)
+        except mdb.Error, e:
+            raise CursorError(cur, e)
+
     def increment(self, address, kind, fn=None, user_agent=None):
         """ Adds a client address into the database """
+        self.add_many([(datetime.datetime.now(), _addr_hash(address),
+                        kind, fn, user_agent)])
+
+    def add_many(self, downloads):
+        """
+        Adds already-hashed (timestamp, addr, kind, fn, user_agent) rows.
+
+        The timestamp is when the download was served rather than when the
+        batch is written, so comes from the app rather than CURRENT_TIMESTAMP.
+        The app and the MySQL server have to use the same time zone, as the
+        stats pages also count days using the app's local date.
+        """
+
+        # count up the rows for each rollup bucket
+        daily = {}
+        hourly = {}
+        sketches = {}
+        user_agents = set()
+        tracked = []
+        downloads = [(timestamp, addr, kind, _truncate(fn), _truncate(user_agent))
+                     for timestamp, addr, kind, fn, user_agent in downloads]
+        for timestamp, addr, kind, fn, user_agent in downloads:
+            _add_to_sketches(sketches, timestamp.date(), kind, fn, addr)
+            if user_agent:
+                user_agents.add(user_agent)
+                if fn == USER_AGENT_FILENAME:
+                    tracked.append((timestamp, user_agent))
+            digest = _rollup_digest(fn, user_agent)
+            for rollup, bucket in [(daily, timestamp.date()),
+                                   (hourly, timestamp.replace(minute=0, second=0,
+                                                              microsecond=0))]:
+                key = (bucket, kind, digest)
+                if key in rollup:
+                    rollup[key][5] += 1
+                else:
+                    rollup[key] = [bucket, kind, fn, user_agent, digest, 1]
+
+        try:
+            cur = self._db.cursor()
+
+            # committed first, as the IDs are cached for the whole process
+            user_agent_ids = _intern_user_agents(cur, user_agents)
+            rows = []
+            for timestamp, addr, kind, fn, user_agent in downloads:
+                rows.append((timestamp, addr, kind, fn, user_agent_ids.get(user_agent)))
+
+            # the download log, rollups and sketches always agree
+            cur.execute("START TRANSACTION;")
+            try:
+                cur.executemany("INSERT INTO clients (timestamp, addr, is_firmware, "
+                                "filename, user_agent_id) VALUES (%s, %s, %s, %s, %s);",
+                                rows)
+                cur.executemany("INSERT INTO clients_daily (day, is_firmware, filename, "
+                                "user_agent, digest, count) VALUES (%s, %s, %s, %s, %s, %s) "
+                                "ON DUPLICATE KEY UPDATE count = count + VALUES(count);",
+                                daily.values())
+                cur.executemany("INSERT INTO clients_hourly (hour, is_firmware, filename, "
+                                "user_agent, digest, count) VALUES (%s, %s, %s, %s, %s, %s) "
+                                "ON DUPLICATE KEY UPDATE count = count + VALUES(count);",
+                                hourly.values())
+                _save_sketches(cur, sketches)
+                cur.execute("COMMIT;")
+            except BaseException:
+                # e.g. a blob that cannot be decoded, which must not leave the
+                # rows locked on a pooled connection
+                cur.execute("ROLLBACK;")
+                raise
+        except mdb.Error, e:
+            raise CursorError(cur, e)
+
+        # only counted once the downloads are saved
+        for timestamp, user_agent in tracked:
+            user_agent_tracker.add(timestamp, user_agent)
+
+    def rebuild_rollups(self, start=None, end=None):
+        """ Recalculates the rollup tables from the download log """
+        try:
+            cur = self._db.cursor()
+            _rebuild_rollups(cur, start, end)
+        except mdb.Error, e:
+            raise CursorError(cur, e)
+
+    def rebuild_sketches(self, start=None, end=None):
+        """ Recalculates the unique address sketches from the download log """
         try:
             cur = self._db.cursor()
-            cur.execute("INSERT INTO clients (addr, is_firmware, filename, user_agent) "
-                        "VALUES (%s, %s, %s, %s);",
-                        (_addr_hash(address), kind, fn, user_agent,))
+            _rebuild_sketches(cur, start, end)
         except mdb.Error, e:
             raise CursorError(cur, e)
 
     def get_stats(self, size, interval, kind):
         """ Gets stats data """
-        data = []
         now = datetime.date.today()
-
-        # yes, there's probably a way to do this in one query with a
-        # 30-level INNER JOIN or something clever...
-        for i in range(size):
-            start = now - datetime.timedelta((i * interval) + interval - 1)
-            end = now - datetime.timedelta((i * interval) - 1)
-            try:
-                cur = self._db.cursor()
-                cur.execute("SELECT COUNT(*) FROM clients "
-                            "WHERE is_firmware = %s AND timestamp >= %s "
-                            "AND timestamp <  %s", (kind, start, end,))
-            except mdb.Error, e:
-                raise CursorError(cur, e)
-            data.append(int(cur.fetchone()[0]))
-        return data
+        start = now - datetime.timedelta((size * interval) - 1)
+        try:
+            cur = self._db.cursor()
+            cur.execute("SELECT day, SUM(count) FROM clients_daily "
+                        "WHERE is_firmware = %s AND day >= %s AND day <= %s "
+                        "GROUP BY day;", (kind, start, now,))
+        except mdb.Error, e:
+            raise CursorError(cur, e)
+        return _bucket_days(cur.fetchall(), size, interval)
 
     def get_stats_for_fn(self, size, interval, filename):
         """ Gets stats data """
-        data = []
         now = datetime.date.today()
+        start = now - datetime.timedelta((size * interval) - 1)
+        try:
+            cur = self._db.cursor()
+            cur.execute("SELECT day, SUM(count) FROM clients_daily "
+                        "WHERE filename = %s AND day >= %s AND day <= %s "
+                        "GROUP BY day;", (filename, start, now,))
+        except mdb.Error, e:
+            raise CursorError(cur, e)
+        return _bucket_days(cur.fetchall(), size, interval)
 
-        # yes, there's probably a way to do this in one query with a
-        # 30-level INNER JOIN or something clever...
-        for i in range(size):
-            start = now - datetime.timedelta((i * interval) + interval - 1)
-            end = now - datetime.timedelta((i * interval) - 1)
-            try:
-                cur = self._db.cursor()
-                cur.execute("SELECT COUNT(*) FROM clients "
-                            "WHERE filename = %s AND timestamp >= %s "
-                            "AND timestamp <  %s", (filename, start, end,))
-            except mdb.Error, e:
-                raise CursorError(cur, e)
-            data.append(int(cur.fetchone()[0]))
-        return data
+    def get_stats_for_fn_by_month(self, filename):
+        """ Gets the number of downloads of a file for each of the last 12 months """
+        now = datetime.date.today()
+        try:
+            cur = self._db.cursor()
+            cur.execute("SELECT YEAR(day), MONTH(day), SUM(count) FROM clients_daily "
+                        "WHERE filename = %s AND day >= %s "
+                        "GROUP BY YEAR(day), MONTH(day);",
+                        (filename, _get_month_start(now),))
+        except mdb.Error, e:
+            raise CursorError(cur, e)
+        return _bucket_months(cur.fetchall(), now)
 
     def get_metadata_by_hour(self):
-        data = []
-        for i in range(24):
-            try:
-                cur = self._db.cursor()
-                cur.execute("SELECT COUNT(*) FROM clients "
-                            "WHERE HOUR(timestamp) = %s;", (i,))
-            except mdb.Error, e:
-                raise CursorError(cur, e)
-            data.append(int(cur.fetchone()[0]))
+        """ Gets the number of downloads for each hour of the day """
+        try:
+            cur = self._db.cursor()
+            cur.execute("SELECT HOUR(hour), SUM(count) FROM clients_hourly "
+                        "GROUP BY HOUR(hour);")
+        except mdb.Error, e:
+            raise CursorError(cur, e)
+        data = [0] * 24
+        for hour, cnt in cur.fetchall():
+            data[hour] = int(cnt)
         return data
 
     def get_metadata_by_month(self, kind):
-        data = []
+        """ Gets the number of downloads for each of the last 12 months """
         now = datetime.date.today()
-        for i in range(0, 12):
-            month_num = now.month - i
-            if month_num < 1:
-                month_num = 12 - month_num
-            try:
-                cur = self._db.cursor()
-                cur.execute("SELECT COUNT(*) FROM clients "
-                            "WHERE is_firmware = %s AND MONTH(timestamp) = %s;",
-                            (kind, month_num,))
-            except mdb.Error, e:
-                raise CursorError(cur, e)
-            data.append(int(cur.fetchone()[0]))
+        start = _get_month_start(now)
+        try:
+            cur = self._db.cursor()
+            cur.execute("SELECT YEAR(day), MONTH(day), SUM(count) FROM clients_daily "
+                        "WHERE is_firmware = %s AND day >= %s "
+                        "GROUP BY YEAR(day), MONTH(day);", (kind, start,))
+        except mdb.Error, e:
+            raise CursorError(cur, e)
+        return _bucket_months(cur.fetchall(), now)
+
+    def get_stats_by_kind(self, size, interval):
+        """ Gets stats data for every kind of download in one query """
+        now = datetime.date.today()
+        start = now - datetime.timedelta((size * interval) - 1)
+        try:
+            cur = self._db.cursor()
+            cur.execute("SELECT is_firmware, day, SUM(count) FROM clients_daily "
+                        "WHERE day >= %s AND day <= %s "
+                        "GROUP BY is_firmware, day;", (start, now,))
+        except mdb.Error, e:
+            raise CursorError(cur, e)
+        res = {}
+        for kind in LvfsDownloadKind.ALL:
+            res[kind] = []
+        for kind, day, cnt in cur.fetchall():
+            if kind in res:
+                res[kind].append((day, cnt))
+        data = {}
+        for kind in res:
+            data[kind] = _bucket_days(res[kind], size, interval)
         return data
+
+    def get_metadata_by_month_by_kind(self):
+        """ Gets the last 12 months of downloads for every kind in one query """
+        now = datetime.date.today()
+        try:
+            cur = self._db.cursor()
+            cur.execute("SELECT is_firmware, YEAR(day), MONTH(day), SUM(count) "
+                        "FROM clients_daily WHERE day >= %s "
+                        "GROUP BY is_firmware, YEAR(day), MONTH(day);",
+                        (_get_month_start(now),))
+        except mdb.Error, e:
+            raise CursorError(cur, e)
+        res = {}
+        for kind in LvfsDownloadKind.ALL:
+            res[kind] = []
+        for kind, year, month, cnt in cur.fetchall():
+            if kind in res:
+                res[kind].append((year, month, cnt))
+        data = {}
+        for kind in res:
+            data[kind] = _bucket_months(res[kind], now)
+        return data
+
+def _write_downloads(downloads):
+    """ Writes a batch of downloads from the recorder thread """
+    db = LvfsDatabase(os.environ)
+    db_clients = LvfsDatabaseClients(db)
+    db_clients.add_many(downloads)
+    try:
+        cur = db.cursor()
+        user_agent_tracker.checkpoint(cur)
+    except mdb.Error, e:
+        raise CursorError(cur, e)
+
+def _checkpoint_user_agents():
+    """ Saves any pending user agent counts when the process exits """
+    db = LvfsDatabase(os.environ)
+    try:
+        cur = db.cursor()
+        user_agent_tracker.checkpoint(cur, force=True)
+    except mdb.Error, e:
+        print 'Failed to save user agents: %s' % str(e)
+
+# registered first so it runs after the recorder has been flushed
+atexit.register(_checkpoint_user_agents)
+
+# downloads are written in batches so serving the file never waits for MySQL
+download_recorder = LvfsBatchWriter(_write_downloads)
+
+def record_download(address, kind, fn=None, user_agent=None):
+    """ Queues a download to be added to the database """
+    download_recorder.add((datetime.datetime.now(),
+                           _addr_hash(address),
+                           kind, fn, user_agent))
@@ -4,13 +4,18 @@
 # Copyright (C) 2015 Richard Hughes <richard@hughsie.com>
 # Licensed under the GNU General Public License Version 2
 
+import os
+import re
 import MySQLdb as mdb
+import datetime
 
-from db import CursorError
+from db import LvfsDatabase, CursorError
+from batch import LvfsBatchWriter
 
 class LvfsEventLogItem(object):
     def __init__(self):
         """ Constructor for object """
+        self.id = None
         self.timestamp = None
         self.username = None
         self.qa_group = None
@@ -20,6 +25,34 @@ class LvfsEventLogItem(object):
     def __repr__(self):
         return "LvfsEventLogItem object %s" % self.message
 
+def _get_words(text):
+    """ Splits text into the lowercase words used by the search index """
+    words = set()
+    for word in re.findall(r'[a-z0-9]+', text.lower()):
+        words.add(word[0:40])
+    return words
+
+def _index_words(cur, rows):
+    """ Adds (id, message) rows to the search index """
+    words = []
+    for item_id, msg in rows:
+        for word in _get_words(msg or ''):
+            words.append((word, item_id))
+    cur.executemany("INSERT IGNORE INTO event_log_words (word, id) "
+                    "VALUES (%s, %s);", words)
+
+def _rebuild_words(cur):
+    """ Indexes every existing event, a chunk at a time """
+    last_id = 0
+    while True:
+        cur.execute("SELECT id, message FROM event_log WHERE id > %s "
+                    "ORDER BY id LIMIT 10000;", (last_id,))
+        rows = cur.fetchall()
+        if not rows:
+            break
+        _index_words(cur, rows)
+        last_id = rows[-1][0]
+
 def _create_eventlog_item(e):
     item = LvfsEventLogItem()
     item.timestamp = e[0]
@@ -28,6 +61,7 @@ def _create_eventlog_item(e):
     item.address = e[3]
     item.message = e[4]
     item.is_important = e[5]
+    item.id = e[6]
     return item
 
 class LvfsDatabaseEventlog(object):
@@ -36,45 +70,44 @@ class LvfsDatabaseEventlog(object):
         """ Constructor for object """
         self._db = db
 
-        # test event log exists
-        try:
-            cur = self._db.cursor()
-            cur.execute("SELECT * FROM event_log LIMIT 1;")
-        except mdb.Error, e:
-            sql_db = """
-                CREATE TABLE event_log (
-                  id INT NOT NULL AUTO_INCREMENT,
-                  timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                  username VARCHAR(40) NOT NULL DEFAULT '',
-                  qa_group VARCHAR(40) DEFAULT NULL,
-                  addr VARCHAR(40) DEFAULT NULL,
-                  message TEXT DEFAULT NULL,
-                  is_important TINYINT DEFAULT 0,
-                  UNIQUE KEY id (id)
-                ) CHARSET=utf8;
-            """
-            cur.execute(sql_db)
-
-        # FIXME: remove after a few days
-        try:
-            sql_db = """
-                ALTER TABLE event_log ADD id INT AUTO_INCREMENT UNIQUE;
-            """
-            cur.execute(sql_db)
-        except mdb.Error, e:
-            pass
-
     def add(self, msg, username, qa_group, addr, is_important):
         """ Adds an item to the event log """
         assert msg
         assert username
         assert qa_group
         assert addr
+        self.add_many([(datetime.datetime.now(), username, qa_group,
+                        addr, msg, is_important)])
+
+    def add_many(self, events):
+        """ Adds (timestamp, username, qa_group, addr, msg, is_important) items """
+        counts = {}
+        for event in events:
+            counts[event[2]] = counts.get(event[2], 0) + 1
         try:
             cur = self._db.cursor()
-            cur.execute("INSERT INTO event_log (username, qa_group, addr, message, is_important) "
-                        "VALUES (%s, %s, %s, %s, %s);",
-                        (username, qa_group, addr, msg, is_important,))
+            cur.execute("START TRANSACTION;")
+            try:
+                # sent as one multi-row INSERT, where lastrowid is the first new ID
+                cur.executemany("INSERT INTO event_log (timestamp, username, qa_group, "
+                                "addr, message, is_important) "
+                                "VALUES (%s, %s, %s, %s, %s, %s);", events)
+                first_id = cur.lastrowid
+
+                # the IDs are only consecutive with innodb_autoinc_lock_mode <= 1,
+                # so read them back; rows from other writers are indexed twice,
+                # which INSERT IGNORE makes harmless
+                cur.execute("SELECT id, message FROM event_log WHERE id >= %s;",
+                            (first_id,))
+                _index_words(cur, cur.fetchall())
+                cur.executemany("INSERT INTO event_log_counts (qa_group, count) "
+                                "VALUES (%s, %s) "
+                                "ON DUPLICATE KEY UPDATE count = count + VALUES(count);",
+                                counts.items())
+                cur.execute("COMMIT;")
+            except mdb.Error:
+                cur.execute("ROLLBACK;")
+                raise
         except mdb.Error, e:
             raise CursorError(cur, e)
 
@@ -82,51 +115,93 @@ class LvfsDatabaseEventlog(object):
         """ Gets the length of the event log """
         try:
             cur = self._db.cursor()
-            cur.execute("SELECT COUNT(timestamp) FROM event_log")
+            cur.execute("SELECT SUM(count) FROM event_log_counts;")
         except mdb.Error, e:
             raise CursorError(cur, e)
         res = cur.fetchone()[0]
         if not res:
             return 0
-        return res
+        return int(res)
 
     def size_for_qa_group(self, qa_group):
         """ Gets the length of the event log """
         try:
             cur = self._db.cursor()
-            cur.execute("SELECT COUNT(timestamp) FROM event_log "
+            cur.execute("SELECT count FROM event_log_counts "
                         "WHERE qa_group = %s", (qa_group,))
         except mdb.Error, e:
             raise CursorError(cur, e)
-        res = cur.fetchone()[0]
+        res = cur.fetchone()
         if not res:
             return 0
-        return res
+        return int(res[0])
+
+    def search(self, length, words=None, username=None, addr=None,
+               start=None, end=None, qa_group=None, before=None):
+        """ Finds event log items, newest first, containing all the words """
+        sql = "SELECT e.timestamp, e.username, e.qa_group, e.addr, e.message, " \
+              "e.is_important, e.id FROM event_log e "
+        where = []
+        args = ()
 
-    def get_items(self, start, length):
-        """ Gets the event log items """
+        # each word is a lookup on the (word, id) primary key
+        for i, word in enumerate(sorted(words or [])):
+            sql += "INNER JOIN event_log_words w%i ON w%i.id = e.id AND w%i.word = %%s " % (i, i, i)
+            args += (word,)
+        if username:
+            where.append("e.username = %s")
+            args += (username,)
+        if addr:
+            where.append("e.addr = %s")
+            args += (addr,)
+        if qa_group:
+            where.append("e.qa_group = %s")
+            args += (qa_group,)
+        if start:
+            where.append("e.timestamp >= %s")
+            args += (start,)
+        if end:
+            where.append("e.timestamp < %s")
+            args += (end,)
+        if before:
+            where.append("e.id < %s")
+            args += (before,)
+        if where:
+            sql += "WHERE " + " AND ".join(where) + " "
+        sql += "ORDER BY e.id DESC LIMIT %s;"
         try:
             cur = self._db.cursor()
-            cur.execute("SELECT timestamp, username, qa_group, addr, message, is_important "
-                        "FROM event_log ORDER BY id DESC LIMIT %s,%s;",
-                        (start, length,))
+            cur.execute(sql, args + (length,))
         except mdb.Error, e:
             raise CursorError(cur, e)
-        res = cur.fetchall()
-        if not res:
-            return []
         items = []
-        for e in res:
+        for e in cur.fetchall():
             items.append(_create_eventlog_item(e))
         return items
 
-    def get_items_for_qa_group(self, qa_group, start, length):
-        """ Gets the event log items """
+    def get_items(self, length, qa_group=None, before=None, after=None):
+        """ Gets the event log items, newest first, before or after an item ID """
+        where = []
+        args = ()
+        if qa_group:
+            where.append("qa_group = %s")
+            args += (qa_group,)
+        order = "DESC"
+        if before:
+            where.append("id < %s")
+            args += (before,)
+        elif after:
+            where.append("id > %s")
+            args += (after,)
+            order = "ASC"
+        sql = "SELECT timestamp, username, qa_group, addr, message, is_important, id " \
+              "FROM event_log "
+        if where:
+            sql += "WHERE " + " AND ".join(where) + " "
+        sql += "ORDER BY id " + order + " LIMIT %s;"
         try:
             cur = self._db.cursor()
-            cur.execute("SELECT timestamp, username, qa_group, addr, message, is_important "
-                        "FROM event_log WHERE qa_group = %s ORDER BY id DESC LIMIT %s,%s;",
-                        (qa_group, start, length,))
+            cur.execute(sql, args + (length,))
         except mdb.Error, e:
             raise CursorError(cur, e)
         res = cur.fetchall()
@@ -135,4 +210,32 @@ class LvfsDatabaseEventlog(object):
         items = []
         for e in res:
             items.append(_create_eventlog_item(e))
+        if order == "ASC":
+            items.reverse()
         return items
+
+def _write_events(events):
+    """ Writes a batch of events from the writer thread """
+    db = LvfsDatabase(os.environ)
+    db_eventlog = LvfsDatabaseEventlog(db)
+    db_eventlog.add_many(events)
+
+# events are written in batches so error pages never wait for MySQL
+eventlog_recorder = LvfsBatchWriter(_write_events, max_batch=100, max_delay=1)
+
+def record_event(msg, username, qa_group, addr, is_important=False, sync=None):
+    """
+    Queues an item for the event log. Unless sync is given, important items
+    are written straight away, on their own and ahead of anything queued.
+    """
+    assert msg
+    assert username
+    assert qa_group
+    assert addr
+    if sync is None:
+        sync = is_important
+    event = (datetime.datetime.now(), username, qa_group, addr, msg, is_important)
+    if sync:
+        eventlog_recorder.add_now(event)
+    else:
+        eventlog_recorder.add(event)
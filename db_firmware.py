@@ -79,78 +79,52 @@ def _create_firmware_item(e):
     item.version_display = e[6]
     return item
 
-class LvfsDatabaseFirmware(object):
+def _get_display_name(mds):
+    """ Gets the name shown for firmware, from the metadata with the largest GUID """
+    mds = sorted(mds, key=lambda md: (md.guid is not None, md.guid), reverse=True)
+    if not mds:
+        return None
+    return mds[0].name
 
-    def __init__(self, db):
-        """ Constructor for object """
-        self._db = db
+def _get_name_target(cur, fwid):
+    """ Gets the (name, target) of firmware, or None """
+    cur.execute("SELECT name, target FROM firmware WHERE fwid = %s;", (fwid,))
+    return cur.fetchone()
 
-        # test firmware table exists
-        try:
-            cur = self._db.cursor()
-            cur.execute("SELECT * FROM firmware LIMIT 1;")
-        except mdb.Error, e:
-            sql_db = """
-                CREATE TABLE firmware (
-                  qa_group VARCHAR(40) NOT NULL DEFAULT '',
-                  addr VARCHAR(40) DEFAULT NULL,
-                  timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                  filename VARCHAR(255) DEFAULT NULL,
-                  target VARCHAR(255) DEFAULT NULL,
-                  fwid VARCHAR(40) DEFAULT NULL,
-                  version_display VARCHAR(255) DEFAULT NULL,
-                  UNIQUE KEY id (fwid)
-                ) CHARSET=utf8;
-            """
-            cur.execute(sql_db)
+def _update_latest(cur, name, target):
+    """ Marks the newest firmware with a name and target, overall and in each QA group """
+    cur.execute("SELECT fwid, qa_group FROM firmware "
+                "WHERE target <=> %s AND name <=> %s "
+                "ORDER BY timestamp DESC, fwid DESC FOR UPDATE;", (target, name,))
+    latest = []
+    latest_in_group = []
+    qa_groups = set()
+    for fwid, qa_group in cur.fetchall():
+        if not latest:
+            latest.append(fwid)
+        if not qa_group in qa_groups:
+            qa_groups.add(qa_group)
+            latest_in_group.append(fwid)
+    cur.execute("UPDATE firmware SET is_latest = 0, is_latest_in_group = 0 "
+                "WHERE target <=> %s AND name <=> %s;", (target, name,))
+    for column, fwids in [('is_latest', latest),
+                          ('is_latest_in_group', latest_in_group)]:
+        if not fwids:
+            continue
+        cur.execute("UPDATE firmware SET " + column + " = 1 WHERE fwid IN (" +
+                    ', '.join(['%s'] * len(fwids)) + ");", fwids)
 
-        # FIXME: remove after a few days
-        try:
-            sql_db = """
-                ALTER TABLE firmware ADD CONSTRAINT id UNIQUE (fwid);
-            """
-            cur.execute(sql_db)
-        except mdb.Error, e:
-            pass
+def _rebuild_latest(cur):
+    """ Recalculates which firmware is the newest for every name and target """
+    cur.execute("SELECT DISTINCT name, target FROM firmware;")
+    for name, target in cur.fetchall():
+        _update_latest(cur, name, target)
 
-        # test firmware metadata table exists
-        try:
-            cur = self._db.cursor()
-            cur.execute("SELECT * FROM firmware_md LIMIT 1;")
-        except mdb.Error, e:
-            sql_db = """
-                CREATE TABLE firmware_md (
-                  fwid VARCHAR(40) DEFAULT NULL,
-                  checksum_contents VARCHAR(40) DEFAULT NULL,
-                  checksum_container VARCHAR(40) DEFAULT NULL,
-                  id TEXT DEFAULT NULL,
-                  name TEXT DEFAULT NULL,
-                  summary TEXT DEFAULT NULL,
-                  guid VARCHAR(36) DEFAULT NULL,
-                  description TEXT DEFAULT NULL,
-                  release_description TEXT DEFAULT NULL,
-                  url_homepage TEXT DEFAULT NULL,
-                  metadata_license TEXT DEFAULT NULL,
-                  project_license TEXT DEFAULT NULL,
-                  developer_name TEXT DEFAULT NULL,
-                  filename_contents TEXT DEFAULT NULL,
-                  release_timestamp INTEGER DEFAULT 0,
-                  version VARCHAR(255) DEFAULT NULL,
-                  release_installed_size INTEGER DEFAULT 0,
-                  release_download_size INTEGER DEFAULT 0,
-                  UNIQUE KEY id (fwid,guid)
-                ) CHARSET=utf8;
-            """
-            cur.execute(sql_db)
+class LvfsDatabaseFirmware(object):
 
-        # FIXME: remove after a few days
-        try:
-            sql_db = """
-                ALTER TABLE firmware_md ADD CONSTRAINT id UNIQUE (fwid,guid);
-            """
-            cur.execute(sql_db)
-        except mdb.Error, e:
-            pass
+    def __init__(self, db):
+        """ Constructor for object """
+        self._db = db
 
     def set_target(self, fwid, target):
         """ get the number of firmware files we've provided """
@@ -158,7 +132,17 @@ class LvfsDatabaseFirmware(object):
         assert target
         try:
             cur = self._db.cursor()
-            cur.execute("UPDATE firmware SET target=%s WHERE fwid=%s;", (target, fwid,))
+            cur.execute("START TRANSACTION;")
+            try:
+                res = _get_name_target(cur, fwid)
+                cur.execute("UPDATE firmware SET target=%s WHERE fwid=%s;", (target, fwid,))
+                if res:
+                    _update_latest(cur, res[0], res[1])
+                    _update_latest(cur, res[0], target)
+                cur.execute("COMMIT;")
+            except mdb.Error:
+                cur.execute("ROLLBACK;")
+                raise
         except mdb.Error, e:
             raise CursorError(cur, e)
 
@@ -204,15 +188,21 @@ class LvfsDatabaseFirmware(object):
         """ Add a firmware object to the database """
         try:
             cur = self._db.cursor()
+            cur.execute("START TRANSACTION;")
+        except mdb.Error, e:
+            raise CursorError(cur, e)
+        try:
+            name = _get_display_name(fwobj.mds)
             cur.execute("INSERT INTO firmware (qa_group, addr, timestamp, "
-                        "filename, fwid, target, version_display) "
-                        "VALUES (%s, %s, CURRENT_TIMESTAMP, %s, %s, %s, %s);",
+                        "filename, fwid, target, version_display, name) "
+                        "VALUES (%s, %s, CURRENT_TIMESTAMP, %s, %s, %s, %s, %s);",
                         (fwobj.qa_group,
                          fwobj.addr,
                          fwobj.filename,
                          fwobj.fwid,
                          fwobj.target,
-                         fwobj.version_display,))
+                         fwobj.version_display,
+                         name,))
             for md in fwobj.mds:
                 cur.execute("INSERT INTO firmware_md (fwid, id, guid, version, "
                             "name, summary, checksum_contents, release_description, "
@@ -241,62 +231,162 @@ class LvfsDatabaseFirmware(object):
                              md.filename_contents,
                              md.release_installed_size,
                              md.release_download_size,))
+            _update_latest(cur, name, fwobj.target)
+            cur.execute("COMMIT;")
         except mdb.Error, e:
+            cur.execute("ROLLBACK;")
             raise CursorError(cur, e)
 
     def remove(self, fwid):
         """ Removes firmware from the database if it exists """
         try:
             cur = self._db.cursor()
-            cur.execute("DELETE FROM firmware WHERE fwid = %s;", (fwid,))
-            cur.execute("DELETE FROM firmware_md WHERE fwid = %s;", (fwid,))
+            cur.execute("START TRANSACTION;")
+            try:
+                res = _get_name_target(cur, fwid)
+                cur.execute("DELETE FROM firmware WHERE fwid = %s;", (fwid,))
+                cur.execute("DELETE FROM firmware_md WHERE fwid = %s;", (fwid,))
+                if res:
+                    _update_latest(cur, res[0], res[1])
+                cur.execute("COMMIT;")
+            except mdb.Error:
+                cur.execute("ROLLBACK;")
+                raise
         except mdb.Error, e:
             raise CursorError(cur, e)
 
-    def _add_items_md(self, item):
+    def _get_items(self, where='', args=(), limit=None):
+        """ Returns firmware objects, loading the metadata in the same query """
+
+        # the limit is for firmware objects, not for the joined rows
+        source = "firmware f"
+        if limit:
+            source = "(SELECT * FROM firmware f " + where + \
+                     " ORDER BY f.timestamp DESC, f.fwid DESC LIMIT %s) f"
+            args = tuple(args) + (limit,)
+            where = ''
         try:
             cur = self._db.cursor()
-            cur.execute("SELECT fwid, id, guid, version, "
-                        "name, summary, checksum_contents, release_description, "
-                        "release_timestamp, developer_name, metadata_license, "
-                        "project_license, url_homepage, description, "
-                        "checksum_container, filename_contents, "
-                        "release_installed_size, release_download_size "
-                        "FROM firmware_md WHERE fwid = %s ORDER BY guid DESC;",
-                        (item.fwid,))
+            cur.execute("SELECT f.qa_group, f.addr, f.timestamp, "
+                        "f.filename, f.fwid, f.target, f.version_display, "
+                        "md.fwid, md.id, md.guid, md.version, "
+                        "md.name, md.summary, md.checksum_contents, md.release_description, "
+                        "md.release_timestamp, md.developer_name, md.metadata_license, "
+                        "md.project_license, md.url_homepage, md.description, "
+                        "md.checksum_container, md.filename_contents, "
+                        "md.release_installed_size, md.release_download_size "
+                        "FROM " + source + " LEFT JOIN firmware_md md ON f.fwid = md.fwid " +
+                        where +
+                        " ORDER BY f.timestamp DESC, f.fwid DESC, md.guid DESC;",
+                        args)
         except mdb.Error, e:
             raise CursorError(cur, e)
         res = cur.fetchall()
         if not res:
             return []
+
+        # rows for the same firmware are always adjacent
         items = []
+        item = None
         for e in res:
-            md = _create_firmware_md(e)
-            item.mds.append(md)
+            if not item or item.fwid != e[4]:
+                item = _create_firmware_item(e)
+                items.append(item)
+            if e[7]:
+                item.mds.append(_create_firmware_md(e[7:]))
+        return items
 
-    def get_items(self):
-        """ Returns all firmware objects """
+    def get_items(self, qa_group=None, target=None, vendor=None, limit=None,
+                  cursor=None, latest_per_target=False):
+        """
+        Returns firmware objects, newest first.
+
+        The target can be a single target or a list of targets, the vendor is
+        the developer name, and the cursor is the fwid of the last firmware
+        object from the previous page. If latest_per_target is set then only
+        the newest firmware for each name and target is returned.
+        """
+        conditions = []
+        args = []
+        if qa_group:
+            conditions.append("f.qa_group = %s")
+            args.append(qa_group)
+        if isinstance(target, list) and target:
+            conditions.append("f.target IN (%s)" % ', '.join(['%s'] * len(target)))
+            args.extend(target)
+        elif target:
+            conditions.append("f.target = %s")
+            args.append(target)
+        if vendor:
+            conditions.append("f.fwid IN (SELECT fwid FROM firmware_md "
+                              "WHERE developer_name = %s)")
+            args.append(vendor)
+        if latest_per_target:
+            # the flags are kept up to date by add, set_target and remove
+            if qa_group:
+                conditions.append("f.is_latest_in_group = 1")
+            else:
+                conditions.append("f.is_latest = 1")
+        if cursor:
+            conditions.append("(f.timestamp < (SELECT timestamp FROM firmware WHERE fwid = %s) OR "
+                              "(f.timestamp = (SELECT timestamp FROM firmware WHERE fwid = %s) "
+                              "AND f.fwid < %s))")
+            args.extend([cursor, cursor, cursor])
+        where = ''
+        if conditions:
+            where = "WHERE " + " AND ".join(conditions)
+        return self._get_items(where, args, limit)
+
+    def get_item(self, fwid):
+        """ Gets a specific firmware object """
+        assert fwid
+        items = self._get_items("WHERE f.fwid = %s", (fwid,))
+        if not items:
+            return None
+        return items[0]
+
+    def exists(self, fwid):
+        """ Returns True if the firmware exists """
+        assert fwid
         try:
             cur = self._db.cursor()
-            cur.execute("SELECT qa_group, addr, timestamp, "
-                        "filename, fwid, target, version_display "
-                        "FROM firmware ORDER BY timestamp DESC;")
+            cur.execute("SELECT 1 FROM firmware WHERE fwid = %s LIMIT 1;", (fwid,))
         except mdb.Error, e:
             raise CursorError(cur, e)
-        res = cur.fetchall()
+        if not cur.fetchone():
+            return False
+        return True
+
+    def find_by_guid_version(self, guid, version):
+        """ Gets the firmware ID that provides a specific GUID and version """
+        assert guid
+        try:
+            cur = self._db.cursor()
+            cur.execute("SELECT fwid FROM firmware_md "
+                        "WHERE guid = %s AND version = %s LIMIT 1;",
+                        (guid, version,))
+        except mdb.Error, e:
+            raise CursorError(cur, e)
+        res = cur.fetchone()
         if not res:
-            return []
-        items = []
-        for e in res:
-            item = _create_firmware_item(e)
-            items.append(item)
-            self._add_items_md(item)
-        return items
+            return None
+        return res[0]
 
-    def get_item(self, fwid):
-        """ Gets a specific firmware object """
-        items = self.get_items()
-        for item in items:
-            if item.fwid == fwid:
-                return item
-        return None
+    def find_guid_for_cid(self, cid, ignore_guid=None):
+        """ Gets a GUID that already uses the component ID, or None """
+        assert cid
+        try:
+            cur = self._db.cursor()
+            if ignore_guid:
+                cur.execute("SELECT guid FROM firmware_md "
+                            "WHERE id = %s AND guid != %s LIMIT 1;",
+                            (cid, ignore_guid,))
+            else:
+                cur.execute("SELECT guid FROM firmware_md "
+                            "WHERE id = %s LIMIT 1;", (cid,))
+        except mdb.Error, e:
+            raise CursorError(cur, e)
+        res = cur.fetchone()
+        if not res:
+            return None
+        return res[0]
@@ -0,0 +1,406 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Richard Hughes <richard@hughsie.com>
+# Licensed under the GNU General Public License Version 2
+
+import os
+import datetime
+import MySQLdb as mdb
+
+from db import LvfsDatabase, CursorError
+from db_users import _password_hash
+from db_clients import _rebuild_rollups, _rebuild_sketches, _rebuild_top_user_agents
+from db_eventlog import _rebuild_words
+from db_firmware import _rebuild_latest
+
+def _execute_optional(cur, sql_db):
+    """ Runs a statement that is allowed to fail, e.g. on an old schema """
+    try:
+        cur.execute(sql_db)
+    except mdb.Error, e:
+        pass
+
+def _has_index(cur, table, name):
+    """ Checks if an index exists, e.g. added by an interrupted migration """
+    cur.execute("SELECT 1 FROM information_schema.STATISTICS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s "
+                "AND INDEX_NAME = %s LIMIT 1;", (table, name,))
+    return cur.fetchone() is not None
+
+def _has_column(cur, table, name):
+    """ Checks if a column exists, e.g. added by an interrupted migration """
+    cur.execute("SELECT 1 FROM information_schema.COLUMNS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s "
+                "AND COLUMN_NAME = %s LIMIT 1;", (table, name,))
+    return cur.fetchone() is not None
+
+def _create_index(cur, table, name, columns):
+    """ Adds an index unless it already exists """
+    if _has_index(cur, table, name):
+        return
+    cur.execute("CREATE INDEX " + name + " ON " + table + " (" + columns + ");")
+
+def _migrate_create_tables(cur):
+    """ Creates the tables, fixing up databases created by older versions """
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS firmware (
+          qa_group VARCHAR(40) NOT NULL DEFAULT '',
+          addr VARCHAR(40) DEFAULT NULL,
+          timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+          filename VARCHAR(255) DEFAULT NULL,
+          target VARCHAR(255) DEFAULT NULL,
+          fwid VARCHAR(40) DEFAULT NULL,
+          version_display VARCHAR(255) DEFAULT NULL,
+          UNIQUE KEY id (fwid)
+        ) CHARSET=utf8;
+    """)
+    _execute_optional(cur, "ALTER TABLE firmware ADD CONSTRAINT id UNIQUE (fwid);")
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS firmware_md (
+          fwid VARCHAR(40) DEFAULT NULL,
+          checksum_contents VARCHAR(40) DEFAULT NULL,
+          checksum_container VARCHAR(40) DEFAULT NULL,
+          id TEXT DEFAULT NULL,
+          name TEXT DEFAULT NULL,
+          summary TEXT DEFAULT NULL,
+          guid VARCHAR(36) DEFAULT NULL,
+          description TEXT DEFAULT NULL,
+          release_description TEXT DEFAULT NULL,
+          url_homepage TEXT DEFAULT NULL,
+          metadata_license TEXT DEFAULT NULL,
+          project_license TEXT DEFAULT NULL,
+          developer_name TEXT DEFAULT NULL,
+          filename_contents TEXT DEFAULT NULL,
+          release_timestamp INTEGER DEFAULT 0,
+          version VARCHAR(255) DEFAULT NULL,
+          release_installed_size INTEGER DEFAULT 0,
+          release_download_size INTEGER DEFAULT 0,
+          UNIQUE KEY id (fwid,guid)
+        ) CHARSET=utf8;
+    """)
+    _execute_optional(cur, "ALTER TABLE firmware_md ADD CONSTRAINT id UNIQUE (fwid,guid);")
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+          username VARCHAR(40) NOT NULL DEFAULT '',
+          password VARCHAR(40) NOT NULL DEFAULT '',
+          display_name VARCHAR(128) DEFAULT NULL,
+          email VARCHAR(255) DEFAULT NULL,
+          pubkey VARCHAR(4096) DEFAULT NULL,
+          is_enabled TINYINT DEFAULT 0,
+          is_qa TINYINT DEFAULT 0,
+          qa_group VARCHAR(40) NOT NULL DEFAULT '',
+          is_locked TINYINT DEFAULT 0,
+          UNIQUE KEY id (username)
+        ) CHARSET=utf8;
+    """)
+    _execute_optional(cur, "ALTER TABLE users ADD CONSTRAINT id UNIQUE (username);")
+    _execute_optional(cur, "ALTER TABLE users ADD pubkey VARCHAR(4096) DEFAULT NULL;")
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS clients (
+          id INT NOT NULL AUTO_INCREMENT,
+          timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+          addr VARCHAR(40) DEFAULT NULL,
+          is_firmware TINYINT DEFAULT 0,
+          filename VARCHAR(256) DEFAULT NULL,
+          user_agent VARCHAR(256) DEFAULT NULL,
+          UNIQUE KEY id (id)
+        ) CHARSET=utf8;
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS event_log (
+          id INT NOT NULL AUTO_INCREMENT,
+          timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+          username VARCHAR(40) NOT NULL DEFAULT '',
+          qa_group VARCHAR(40) DEFAULT NULL,
+          addr VARCHAR(40) DEFAULT NULL,
+          message TEXT DEFAULT NULL,
+          is_important TINYINT DEFAULT 0,
+          UNIQUE KEY id (id)
+        ) CHARSET=utf8;
+    """)
+    _execute_optional(cur, "ALTER TABLE event_log ADD id INT AUTO_INCREMENT UNIQUE;")
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS cache (
+          created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+          filename VARCHAR(255) DEFAULT NULL,
+          data BLOB DEFAULT NULL,
+          UNIQUE KEY filename (filename)
+        ) CHARSET=utf8;
+    """)
+
+    # ensure an admin user always exists
+    cur.execute("SELECT is_enabled FROM users WHERE username='admin';")
+    if not cur.fetchone():
+        cur.execute("INSERT INTO users (username, password, display_name, email, "
+                    "is_enabled, is_qa, is_locked, qa_group) "
+                    "VALUES ('admin', 'Pa$$w0rd', 'Admin User', 'sign-test@fwupd.org', "
+                    "1, 1, 0, 'admin');")
+
+    # convert legacy passwords from strings to hashes
+    cur.execute("SELECT username, password FROM users;")
+    for l in cur.fetchall():
+        if len(l[1]) == 40:
+            continue
+        cur.execute("UPDATE users SET password=%s WHERE username=%s;",
+                    (_password_hash(l[1]), l[0],))
+
+    # ensure admin has all privs
+    cur.execute("UPDATE users SET is_enabled=1, is_qa=1, is_locked=0, qa_group='admin' "
+                "WHERE username='admin';")
+
+def _migrate_add_indexes(cur):
+    """ Adds the secondary indexes used by the point lookups """
+
+    # long utf8 columns only use a prefix to fit in the index key size
+    _create_index(cur, 'firmware_md', 'guid_version', 'guid, version(100)')
+    _create_index(cur, 'firmware_md', 'cid', 'id(255)')
+    _create_index(cur, 'firmware', 'qa_group_target', 'qa_group, target(100)')
+    _create_index(cur, 'clients', 'filename_timestamp', 'filename(200), timestamp')
+
+def _migrate_add_listing_indexes(cur):
+    """ Adds the indexes used when filtering and paging the firmware list """
+    _create_index(cur, 'firmware', 'qa_group_timestamp', 'qa_group, timestamp, fwid')
+    _create_index(cur, 'firmware', 'timestamp', 'timestamp, fwid')
+    _create_index(cur, 'firmware_md', 'developer_name', 'developer_name(100)')
+
+def _migrate_add_rollups(cur):
+    """ Adds the daily and hourly download counts, and fills them in """
+    for table, column in [('clients_daily', 'day DATE'),
+                          ('clients_hourly', 'hour DATETIME')]:
+        cur.execute("CREATE TABLE IF NOT EXISTS " + table + " (" + column + " NOT NULL, "
+                    "is_firmware TINYINT NOT NULL DEFAULT 0, "
+                    "filename VARCHAR(256) DEFAULT NULL, "
+                    "user_agent VARCHAR(256) DEFAULT NULL, "
+                    "digest CHAR(40) NOT NULL, "
+                    "count INT NOT NULL DEFAULT 0, "
+                    "UNIQUE KEY id (" + column.split(' ')[0] + ", is_firmware, digest), "
+                    "KEY filename (filename(200), " + column.split(' ')[0] + ")"
+                    ") CHARSET=utf8;")
+
+    # this is _rebuild_rollups() as it was when the migration was added, as
+    # clients still has the user_agent column at this version
+    for table, bucket in [('clients_daily', 'DATE(timestamp)'),
+                          ('clients_hourly', "DATE_FORMAT(timestamp, '%Y-%m-%d %H:00:00')")]:
+        cur.execute("INSERT INTO " + table + " "
+                    "SELECT " + bucket + ", is_firmware, filename, user_agent, "
+                    "SHA1(CONCAT(IFNULL(filename, ''), '\\n', IFNULL(user_agent, ''))), "
+                    "COUNT(*) FROM clients "
+                    "GROUP BY 1, is_firmware, filename, user_agent "
+                    "ON DUPLICATE KEY UPDATE count = VALUES(count);")
+
+def _migrate_add_sketches(cur):
+    """ Adds the unique address sketches, and fills them in """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS clients_hll (
+          day DATE NOT NULL,
+          is_firmware TINYINT NOT NULL DEFAULT 0,
+          filename VARCHAR(256) NOT NULL DEFAULT '',
+          sketch BLOB DEFAULT NULL,
+          UNIQUE KEY id (day, is_firmware, filename(200)),
+          KEY filename (filename(200), day)
+        ) CHARSET=utf8;
+    """)
+    _rebuild_sketches(cur)
+
+def _migrate_intern_user_agents(cur):
+    """ Moves the user agent strings into a lookup table """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_agents (
+          id INT NOT NULL AUTO_INCREMENT,
+          digest CHAR(40) NOT NULL,
+          user_agent VARCHAR(256) NOT NULL,
+          PRIMARY KEY (id),
+          UNIQUE KEY digest (digest)
+        ) CHARSET=utf8;
+    """)
+    if _has_column(cur, 'clients', 'user_agent'):
+        cur.execute("INSERT IGNORE INTO user_agents (digest, user_agent) "
+                    "SELECT DISTINCT SHA1(user_agent), user_agent FROM clients "
+                    "WHERE user_agent IS NOT NULL;")
+        if not _has_column(cur, 'clients', 'user_agent_id'):
+            cur.execute("ALTER TABLE clients ADD user_agent_id INT DEFAULT NULL;")
+        cur.execute("UPDATE clients INNER JOIN user_agents "
+                    "ON user_agents.digest = SHA1(clients.user_agent) "
+                    "SET clients.user_agent_id = user_agents.id;")
+        cur.execute("ALTER TABLE clients DROP COLUMN user_agent;")
+
+    # the most common user agents for each day and month
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS clients_topk (
+          period VARCHAR(10) NOT NULL,
+          data BLOB DEFAULT NULL,
+          UNIQUE KEY id (period)
+        ) CHARSET=utf8;
+    """)
+    now = datetime.date.today()
+    for period in [now.strftime('%Y-%m-%d'), now.strftime('%Y-%m')]:
+        _rebuild_top_user_agents(cur, period)
+
+def _migrate_add_clients_timestamp_index(cur):
+    """ Adds the index used when archiving old downloads """
+    _create_index(cur, 'clients', 'timestamp', 'timestamp')
+
+def _migrate_add_eventlog_counts(cur):
+    """ Adds the event log index used for paging, and the row counts """
+    _create_index(cur, 'event_log', 'qa_group_id', 'qa_group, id')
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS event_log_counts (
+          qa_group VARCHAR(40) NOT NULL DEFAULT '',
+          count INT NOT NULL DEFAULT 0,
+          UNIQUE KEY id (qa_group)
+        ) CHARSET=utf8;
+    """)
+    cur.execute("INSERT INTO event_log_counts (qa_group, count) "
+                "SELECT IFNULL(qa_group, ''), COUNT(*) FROM event_log "
+                "GROUP BY IFNULL(qa_group, '') "
+                "ON DUPLICATE KEY UPDATE count = VALUES(count);")
+
+def _migrate_add_eventlog_search(cur):
+    """ Adds the event log search index """
+    _create_index(cur, 'event_log', 'username_id', 'username, id')
+    _create_index(cur, 'event_log', 'addr_id', 'addr, id')
+    _create_index(cur, 'event_log', 'timestamp', 'timestamp')
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS event_log_words (
+          word VARCHAR(40) NOT NULL,
+          id INT NOT NULL,
+          PRIMARY KEY (word, id)
+        ) CHARSET=utf8;
+    """)
+    _rebuild_words(cur)
+
+def _migrate_rebuild_rollups(cur):
+    """ Recalculates the rollups from the interned user agents """
+
+    # archived days are no longer in clients, so their rollups are kept
+    cur.execute("SELECT DATE(MIN(timestamp)) FROM clients;")
+    start = cur.fetchone()[0]
+    if not start:
+        return
+    cur.execute("START TRANSACTION;")
+    try:
+        cur.execute("DELETE FROM clients_daily WHERE day >= %s;", (start,))
+        cur.execute("DELETE FROM clients_hourly WHERE hour >= %s;", (start,))
+        _rebuild_rollups(cur, start)
+        cur.execute("COMMIT;")
+    except mdb.Error:
+        cur.execute("ROLLBACK;")
+        raise
+
+def _migrate_add_eventlog_words_id_index(cur):
+    """ Adds the index used when backing up only the new search index rows """
+    _create_index(cur, 'event_log_words', 'id', 'id')
+
+def _migrate_add_firmware_latest(cur):
+    """ Adds the display name and newest-per-target flags used by the firmware list """
+    if not _has_column(cur, 'firmware', 'name'):
+        cur.execute("ALTER TABLE firmware "
+                    "ADD name VARCHAR(255) CHARACTER SET utf8 COLLATE utf8_bin DEFAULT NULL, "
+                    "ADD is_latest TINYINT NOT NULL DEFAULT 0, "
+                    "ADD is_latest_in_group TINYINT NOT NULL DEFAULT 0;")
+    cur.execute("UPDATE firmware f SET f.name = (SELECT md.name FROM firmware_md md "
+                "WHERE md.fwid = f.fwid ORDER BY md.guid DESC LIMIT 1);")
+    _rebuild_latest(cur)
+    _create_index(cur, 'firmware', 'target_name', 'target(100), name(100), timestamp, fwid')
+    _create_index(cur, 'firmware', 'is_latest', 'is_latest, timestamp, fwid')
+    _create_index(cur, 'firmware', 'qa_group_is_latest',
+                  'qa_group, is_latest_in_group, timestamp, fwid')
+
+# these are run in order by 'python db_schema.py' from the deploy hook; each
+# one is only ever completed once, but has to be safe to run again as MySQL
+# cannot roll back DDL if a migration fails part way through
+_MIGRATIONS = [
+    (1, _migrate_create_tables),
+    (2, _migrate_add_indexes),
+    (3, _migrate_add_listing_indexes),
+    (4, _migrate_add_rollups),
+    (5, _migrate_add_sketches),
+    (6, _migrate_intern_user_agents),
+    (7, _migrate_add_clients_timestamp_index),
+    (8, _migrate_add_eventlog_counts),
+    (9, _migrate_add_eventlog_search),
+    (10, _migrate_rebuild_rollups),
+    (11, _migrate_add_eventlog_words_id_index),
+    (12, _migrate_add_firmware_latest),
+]
+
+class LvfsDatabaseSchema(object):
+
+    def __init__(self, db):
+        """ Constructor for object """
+        self._db = db
+
+    def get_version(self):
+        """ Gets the schema version of the database """
+        try:
+            cur = self._db.cursor()
+            cur.execute("CREATE TABLE IF NOT EXISTS schema_version ("
+                        "version INT NOT NULL DEFAULT 0) CHARSET=utf8;")
+            cur.execute("SELECT version FROM schema_version LIMIT 1;")
+        except mdb.Error, e:
+            raise CursorError(cur, e)
+        res = cur.fetchone()
+        if not res:
+            return 0
+        return res[0]
+
+    def _set_version(self, version):
+        """ Sets the schema version of the database """
+        try:
+            cur = self._db.cursor()
+            cur.execute("DELETE FROM schema_version;")
+            cur.execute("INSERT INTO schema_version (version) VALUES (%s);", (version,))
+        except mdb.Error, e:
+            raise CursorError(cur, e)
+
+    def get_latest_version(self):
+        """ Gets the schema version this code expects """
+        return _MIGRATIONS[-1][0]
+
+    def check(self):
+        """ Raises RuntimeError unless the migrations have all been applied """
+        version = self.get_version()
+        if version < self.get_latest_version():
+            raise RuntimeError('Database schema is version %i but %i is required, '
+                               'run db_schema.py' % (version, self.get_latest_version()))
+
+    def update(self):
+        """ Runs any migrations not already applied, returning the number run """
+
+        # only one process is allowed to migrate at any one time
+        cur = self._db.cursor()
+        cur.execute("SELECT GET_LOCK('lvfs_schema', 3600);")
+        if not cur.fetchone()[0]:
+            raise RuntimeError('Unable to get the schema lock')
+        cnt = 0
+        try:
+            version = self.get_version()
+            for migration_version, func in _MIGRATIONS:
+                if migration_version <= version:
+                    continue
+                migration_cur = self._db.cursor()
+                try:
+                    func(migration_cur)
+                except mdb.Error, e:
+                    raise CursorError(migration_cur, e)
+                self._set_version(migration_version)
+                cnt += 1
+        finally:
+            cur.execute("SELECT RELEASE_LOCK('lvfs_schema');")
+        return cnt
+
+def main():
+    db = LvfsDatabase(os.environ)
+    schema = LvfsDatabaseSchema(db)
+    cnt = schema.update()
+    print 'Applied %i migrations, schema is now version %i' % (cnt, schema.get_version())
+
+if __name__ == "__main__":
+    main()
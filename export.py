@@ -0,0 +1,181 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Richard Hughes <richard@hughsie.com>
+# Licensed under the GNU General Public License Version 2
+#
+# Exports the download log into one compressed columnar file per day, so
+# that it can be analyzed offline rather than on the production database.
+#
+# Each clients-YYYY-MM-DD.json.gz file contains:
+#  - filenames, user_agents, addrs: the dictionary of each distinct value
+#  - id, timestamp: the first value, then the difference from the previous row
+#  - kind: the LvfsDownloadKind
+#  - filename, user_agent, addr: indexes into the dictionaries, or -1 for NULL
+#
+# Only whole days before today are exported. The last exported day is saved
+# in watermark.json, and the next run starts from the day after it.
+
+import os
+import sys
+import json
+import gzip
+import datetime
+import calendar
+import MySQLdb as mdb
+import MySQLdb.cursors
+
+from config import EXPORT_DIR
+from db import LvfsDatabase, CursorError
+
+class LvfsExportDay(object):
+    """ The columns for the downloads on one day """
+
+    def __init__(self, day):
+        """ Constructor for object """
+        self.day = day
+        self.columns = {'id': [], 'timestamp': [], 'kind': [],
+                        'filename': [], 'user_agent': [], 'addr': []}
+        self.dictionaries = {'filename': [], 'user_agent': [], 'addr': []}
+        self._indexes = {'filename': {}, 'user_agent': {}, 'addr': {}}
+        self._last_id = 0
+        self._last_timestamp = 0
+
+    def _encode(self, column, value):
+        """ Adds a value to a dictionary-encoded column """
+        if value is None:
+            self.columns[column].append(-1)
+            return
+        indexes = self._indexes[column]
+        if not value in indexes:
+            indexes[value] = len(self.dictionaries[column])
+            self.dictionaries[column].append(value)
+        self.columns[column].append(indexes[value])
+
+    def add(self, row_id, timestamp, addr, kind, fn, user_agent):
+        """ Adds a row from the clients table """
+        secs = calendar.timegm(timestamp.timetuple())
+        self.columns['id'].append(row_id - self._last_id)
+        self.columns['timestamp'].append(secs - self._last_timestamp)
+        self.columns['kind'].append(kind)
+        self._encode('filename', fn)
+        self._encode('user_agent', user_agent)
+        self._encode('addr', addr)
+        self._last_id = row_id
+        self._last_timestamp = secs
+
+    def write(self, directory):
+        """ Saves the columns, returning the number of rows """
+        data = {'day': self.day.strftime('%Y-%m-%d'),
+                'rows': len(self.columns['id']),
+                'filenames': self.dictionaries['filename'],
+                'user_agents': self.dictionaries['user_agent'],
+                'addrs': self.dictionaries['addr'],
+                'columns': self.columns}
+        filename = os.path.join(directory, 'clients-' + data['day'] + '.json.gz')
+        with gzip.open(filename + '.tmp', 'wb') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.rename(filename + '.tmp', filename)
+        return data['rows']
+
+def load_day(filename):
+    """ Reads an exported day, returning (id, timestamp, addr, kind, fn, user_agent) rows """
+    with gzip.open(filename, 'rb') as f:
+        data = json.load(f)
+    columns = data['columns']
+    row_id = 0
+    secs = 0
+    rows = []
+    for i in range(data['rows']):
+        row_id += columns['id'][i]
+        secs += columns['timestamp'][i]
+        values = []
+        for column, dictionary in [('addr', 'addrs'),
+                                   ('filename', 'filenames'),
+                                   ('user_agent', 'user_agents')]:
+            idx = columns[column][i]
+            if idx < 0:
+                values.append(None)
+            else:
+                values.append(data[dictionary][idx])
+        rows.append((row_id, datetime.datetime.utcfromtimestamp(secs), values[0],
+                     columns['kind'][i], values[1], values[2]))
+    return rows
+
+def _get_watermark():
+    """ Gets the last day that was exported, or None """
+    filename = os.path.join(EXPORT_DIR, 'watermark.json')
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as f:
+        data = json.load(f)
+    return datetime.datetime.strptime(data['day'], '%Y-%m-%d').date()
+
+def _set_watermark(day):
+    """ Saves the last day that was exported """
+    filename = os.path.join(EXPORT_DIR, 'watermark.json')
+    with open(filename + '.tmp', 'wb') as f:
+        json.dump({'day': day.strftime('%Y-%m-%d')}, f)
+    os.rename(filename + '.tmp', filename)
+
+def export_clients(full=False):
+    """ Exports every whole day since the watermark, returning the number of rows """
+    if not os.path.exists(EXPORT_DIR):
+        os.mkdir(EXPORT_DIR)
+    start = None
+    if not full:
+        start = _get_watermark()
+        if start:
+            start += datetime.timedelta(1)
+    end = datetime.date.today()
+
+    # stream the rows so that the whole table is never held in memory
+    where = "WHERE c.timestamp < %s "
+    args = (end,)
+    if start:
+        where += "AND c.timestamp >= %s "
+        args += (start,)
+    db = LvfsDatabase(os.environ)
+    cnt = 0
+    try:
+        cur = db.cursor(MySQLdb.cursors.SSCursor)
+        cur.execute("SELECT c.id, c.timestamp, c.addr, c.is_firmware, c.filename, "
+                    "ua.user_agent FROM clients c "
+                    "LEFT JOIN user_agents ua ON ua.id = c.user_agent_id " + where +
+                    "ORDER BY c.timestamp, c.id;", args)
+        export_day = None
+        for row in cur:
+            day = row[1].date()
+            if export_day and export_day.day != day:
+                cnt += export_day.write(EXPORT_DIR)
+                _set_watermark(export_day.day)
+                export_day = None
+            if not export_day:
+                export_day = LvfsExportDay(day)
+            export_day.add(*row)
+        if export_day:
+            cnt += export_day.write(EXPORT_DIR)
+        cur.close()
+    except mdb.Error, e:
+        db.discard()
+        raise CursorError(cur, e)
+    except BaseException:
+        # a streaming cursor may still have unread rows, so nothing else
+        # can be sent on this connection
+        db.discard()
+        raise
+
+    # days with no downloads have no file, but are still done
+    _set_watermark(end - datetime.timedelta(1))
+    return cnt
+
+def main():
+    if len(sys.argv) > 2 or (len(sys.argv) == 2 and sys.argv[1] != 'full'):
+        print 'Usage: %s [full]' % sys.argv[0]
+        return 1
+    cnt = export_clients(len(sys.argv) == 2)
+    print 'Exported %i rows to %s' % (cnt, EXPORT_DIR)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
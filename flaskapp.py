@@ -8,8 +8,10 @@ import os
 from flask import Flask, flash, render_template, redirect, request, send_from_directory
 
 from db import LvfsDatabase, CursorError
-from db_clients import LvfsDatabaseClients, LvfsDownloadKind
+from db_clients import LvfsDownloadKind, record_download
+from livestats import live_stats
 from db_cache import LvfsDatabaseCache
+from db_schema import LvfsDatabaseSchema
 
 def _get_client_address():
     """ Gets user IP address """
@@ -20,12 +22,16 @@ def _get_client_address():
 
 ################################################################################
 
-from lvfs import lvfs
+from lvfs import lvfs, ensure_embargo_metadata
+from affidavit import NoKeyError
 
 app = Flask(__name__)
 app.config.from_pyfile('flaskapp.cfg')
 app.register_blueprint(lvfs)
 
+# the per-table objects assume the deploy hook already migrated the schema
+LvfsDatabaseSchema(LvfsDatabase(os.environ)).check()
+
 ################################################################################
 
 @app.errorhandler(404)
@@ -69,15 +75,23 @@ def serveStaticResource(resource):
     elif resource.endswith('.xml.gz'):
         kind = LvfsDownloadKind.METADATA
     if kind is not None:
+        record_download(_get_client_address(),
+                        kind,
+                        os.path.basename(resource),
+                        request.headers.get('User-Agent'))
+        try:
+            live_stats.increment(kind)
+        except (IOError, OSError) as e:
+            print 'Failed to update live stats: %s' % str(e)
+
+    # embargo metadata is generated the first time it is requested
+    if resource.startswith('downloads/firmware-'):
+        basename = os.path.basename(resource)
+        if basename.endswith('.asc'):
+            basename = basename[:-4]
         try:
-            filename = os.path.basename(resource)
-            db = LvfsDatabase(os.environ)
-            clients = LvfsDatabaseClients(db)
-            clients.increment(_get_client_address(),
-                              kind,
-                              filename,
-                              request.headers.get('User-Agent'))
-        except CursorError as e:
+            ensure_embargo_metadata(basename)
+        except (CursorError, NoKeyError) as e:
             print str(e)
 
     # use apache for the static file so we can scale
@@ -0,0 +1,66 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Richard Hughes <richard@hughsie.com>
+# Licensed under the GNU General Public License Version 2
+
+import math
+import zlib
+import hashlib
+
+class HyperLogLog(object):
+    """
+    A mergeable sketch that estimates the number of unique values added.
+
+    With the default precision of 14 there are 16384 one-byte registers,
+    giving a standard error of about 0.8%.
+    """
+
+    def __init__(self, precision=14):
+        """ Constructor for object """
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        """ Adds a value to the sketch """
+        x = int(hashlib.sha1(value).hexdigest()[0:16], 16)
+        bits = 64 - self.precision
+        idx = x >> bits
+        w = x & ((1 << bits) - 1)
+        rank = bits - w.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other):
+        """ Adds all the values from another sketch """
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge sketches with different precision')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        """ Estimates the number of unique values """
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        total = 0.0
+        zeros = 0
+        for rank in self.registers:
+            total += 1.0 / (1 << rank)
+            if rank == 0:
+                zeros += 1
+        estimate = alpha * m * m / total
+
+        # small cardinalities are more accurate using linear counting
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def to_blob(self):
+        """ Exports the sketch in a compact form """
+        return chr(self.precision) + zlib.compress(str(self.registers))
+
+    @staticmethod
+    def from_blob(blob):
+        """ Imports a sketch exported using to_blob() """
+        hll = HyperLogLog(ord(blob[0]))
+        hll.registers = bytearray(zlib.decompress(blob[1:]))
+        return hll
@@ -0,0 +1,111 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Richard Hughes <richard@hughsie.com>
+# Licensed under the GNU General Public License Version 2
+
+import os
+import mmap
+import time
+import fcntl
+import struct
+import threading
+
+from config import LIVESTATS_FILE
+from db_clients import LvfsDownloadKind
+
+# each slot is the second or minute it counts, then one counter per kind
+_SLOT = struct.Struct('<q%iI' % len(LvfsDownloadKind.ALL))
+
+class LvfsLiveStatsRing(object):
+    """ A ring of counters where each slot covers interval seconds """
+
+    def __init__(self, offset, nr_slots, interval):
+        """ Constructor for object """
+        self.offset = offset
+        self.nr_slots = nr_slots
+        self.interval = interval
+        self.size = nr_slots * _SLOT.size
+
+    def increment(self, buf, kind, now):
+        """ Counts a download, clearing the slot if it is from a previous lap """
+        stamp = int(now) / self.interval
+        pos = self.offset + (stamp % self.nr_slots) * _SLOT.size
+        values = list(_SLOT.unpack_from(buf, pos))
+        if values[0] != stamp:
+            values = [stamp] + [0] * len(LvfsDownloadKind.ALL)
+        values[kind + 1] += 1
+        _SLOT.pack_into(buf, pos, *values)
+
+    def get(self, buf, count, now):
+        """ Gets (timestamp, counts) for the last count slots, oldest first """
+        stamp = int(now) / self.interval
+        data = []
+        for i in range(min(count, self.nr_slots) - 1, -1, -1):
+            pos = self.offset + ((stamp - i) % self.nr_slots) * _SLOT.size
+            values = _SLOT.unpack_from(buf, pos)
+            if values[0] != stamp - i:
+                values = [stamp - i] + [0] * len(LvfsDownloadKind.ALL)
+            data.append(((stamp - i) * self.interval, list(values[1:])))
+        return data
+
+class LvfsLiveStats(object):
+    """
+    Per-second and per-minute download counters shared by all the worker
+    processes through a memory-mapped file, so the current load can be seen
+    without touching the database.
+    """
+
+    def __init__(self, filename, nr_seconds=300, nr_minutes=60):
+        """ Constructor for object """
+        self.filename = filename
+        self.seconds = LvfsLiveStatsRing(0, nr_seconds, 1)
+        self.minutes = LvfsLiveStatsRing(self.seconds.size, nr_minutes, 60)
+        self._size = self.seconds.size + self.minutes.size
+        self._lock = threading.Lock()
+        self._fd = None
+        self._buf = None
+        self._pid = None
+
+    def _ensure_mapped(self):
+        """ Opens the shared file, also after the process forked """
+        if self._pid == os.getpid():
+            return
+        if self._fd is not None:
+            self._buf.close()
+            os.close(self._fd)
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0644)
+        if os.fstat(fd).st_size < self._size:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size < self._size:
+                os.ftruncate(fd, self._size)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self._buf = mmap.mmap(fd, self._size)
+        self._fd = fd
+        self._pid = os.getpid()
+
+    def increment(self, kind):
+        """ Counts a download of a LvfsDownloadKind """
+        now = time.time()
+        with self._lock:
+            self._ensure_mapped()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                self.seconds.increment(self._buf, kind, now)
+                self.minutes.increment(self._buf, kind, now)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def get(self, nr_seconds, nr_minutes):
+        """ Gets the last nr_seconds and nr_minutes of counters, oldest first """
+        now = time.time()
+        with self._lock:
+            self._ensure_mapped()
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+            try:
+                return (self.seconds.get(self._buf, nr_seconds, now),
+                        self.minutes.get(self._buf, nr_minutes, now))
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+live_stats = LvfsLiveStats(LIVESTATS_FILE)
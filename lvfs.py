@@ -5,30 +5,38 @@
 # Licensed under the GNU General Public License Version 2
 
 import os
+import cgi
+import json
+import urllib
 import hashlib
-import math
 import glob
-import calendar
+import time
 import datetime
+import thread
 import ConfigParser
 
 from flask import Blueprint, session, request, flash, url_for, redirect, \
-     render_template, abort
+     render_template, abort, Response
 
 import cabarchive
 import appstream
-from affidavit import Affidavit, NoKeyError
-from db import LvfsDatabase, CursorError
-from db_clients import LvfsDatabaseClients, LvfsDownloadKind
-from db_eventlog import LvfsDatabaseEventlog
+from affidavit import NoKeyError, get_affidavit
+from analytics import analytics_cache
+from db import LvfsDatabase, CursorError, get_pool_stats
+from db_clients import LvfsDatabaseClients, LvfsDownloadKind, download_recorder
+from db_eventlog import LvfsDatabaseEventlog, record_event, eventlog_recorder, _get_words
 from db_firmware import LvfsDatabaseFirmware, LvfsFirmware, LvfsFirmwareMd
 from db_users import LvfsDatabaseUsers, _password_hash
 from db_cache import LvfsDatabaseCache
 from inf_parser import InfParser
+from livestats import live_stats
 from backup import ensure_checkpoint
-from config import DOWNLOAD_DIR, UPLOAD_DIR, CABEXTRACT_CMD, KEYRING_DIR
+from config import DOWNLOAD_DIR, UPLOAD_DIR, CABEXTRACT_CMD, KEYRING_DIR, \
+     SIGCACHE_DIR
 from util import _qa_hash
-from metadata import metadata_update_qa_group, metadata_update_targets
+from metadata import metadata_update_qa_group, metadata_update_targets, \
+     metadata_invalidate_qa_group, metadata_qa_group_for_filename, \
+     metadata_lock_qa_group, metadata_get_generation
 
 def sizeof_fmt(num, suffix='B'):
     """ Generate user-visible size """
@@ -64,46 +72,60 @@ def _email_check(value):
         return False
     return True
 
-def _get_chart_labels_months():
-    """ Gets the chart labels """
-    now = datetime.date.today()
-    labels = []
-    offset = 0
+# the names used for each LvfsDownloadKind in the JSON API
+_KIND_NAMES = {LvfsDownloadKind.METADATA: 'metadata',
+               LvfsDownloadKind.FIRMWARE: 'firmware',
+               LvfsDownloadKind.SIGNING: 'signing'}
+
+def _get_bucket_keys_days(now, size):
+    """ Gets the keys for daily buckets, newest first """
+    keys = []
+    for i in range(0, size):
+        keys.append((now - datetime.timedelta(i)).strftime('%Y-%m-%d'))
+    return keys
+
+def _get_bucket_keys_months(now):
+    """ Gets the keys for the last 12 months, newest first """
+    keys = []
     for i in range(0, 12):
-        if now.month - i == 0:
-            offset = 1
-        labels.append(calendar.month_name[now.month - i - offset])
-    return labels
-
-def _get_chart_labels_days():
-    """ Gets the chart labels """
-    now = datetime.date.today()
-    labels = []
-    for i in range(0, 30):
-        then = now - datetime.timedelta(i)
-        labels.append("%02i-%02i-%02i" % (then.year, then.month, then.day))
-    return labels
-
-def _get_chart_labels_hours():
-    """ Gets the chart labels """
-    labels = []
-    for i in range(0, 24):
-        labels.append("%02i" % i)
-    return labels
-
-def _to_javascript_array(arr):
-    tmp = '['
-    for a in arr:
-        if type(a) == unicode:
-            tmp += '"' + a + '",'
-        elif type(a) == long:
-            tmp += str(a) + ','
-        else:
-            tmp += '"' + str(a) + '",'
-    if len(tmp) > 1:
-        tmp = tmp[:-1]
-    tmp += ']'
-    return tmp
+        year = now.year
+        month = now.month - i
+        if month < 1:
+            year -= 1
+            month += 12
+        keys.append('%04i-%02i' % (year, month))
+    return keys
+
+def _get_series(keys, series, since=None):
+    """ Converts newest-first bucket values into JSON buckets, oldest first """
+    buckets = []
+    for i in range(len(keys) - 1, -1, -1):
+        if since and keys[i] < since:
+            continue
+        bucket = {'key': keys[i]}
+        for name in series:
+            bucket[name] = series[name][i]
+        buckets.append(bucket)
+    return {'size': len(keys), 'since': since, 'buckets': buckets}
+
+def _json_response(data):
+    """ Returns JSON with a strong ETag, or 304 if the client already has it """
+    body = json.dumps(data, sort_keys=True)
+    etag = hashlib.sha1(body).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+
+    # the browser has to ask each time, but can reuse what it has
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def _json_error(msg, status):
+    """ Returns an error for the JSON API """
+    return Response(json.dumps({'error': msg}), status=status,
+                    mimetype='application/json')
 
 def _get_client_address():
     """ Gets user IP address """
@@ -112,7 +134,7 @@ def _get_client_address():
     else:
         return request.remote_addr
 
-def _event_log(msg, is_important=False):
+def _event_log(msg, is_important=False, sync=None):
     """ Adds an item to the event log """
     username = None
     qa_group = None
@@ -124,10 +146,8 @@ def _event_log(msg, is_important=False):
         qa_group = session['qa_group']
     if not qa_group:
         qa_group = 'admin'
-    db = LvfsDatabase(os.environ)
-    db_eventlog = LvfsDatabaseEventlog(db)
-    db_eventlog.add(msg, username, qa_group,
-                    _get_client_address(), is_important)
+    record_event(msg, username, qa_group,
+                 _get_client_address(), is_important, sync)
 
 def _check_session():
     if not 'username' in session:
@@ -140,28 +160,102 @@ def _check_session():
         return False
     return True
 
+# the admin email address is only looked up again after this many seconds
+_signing_uid = None
+_signing_uid_timestamp = 0
+SIGNING_UID_TIMEOUT = 300
+
+def _invalidate_signing_uid():
+    """ Forces the signing UID to be looked up again """
+    global _signing_uid
+    _signing_uid = None
+
 def create_affidavit():
-    """ Create an affidavit that can be used to sign files """
-    db = LvfsDatabase(os.environ)
-    db_users = LvfsDatabaseUsers(db)
-    key_uid = db_users.get_signing_uid()
-    return Affidavit(key_uid, KEYRING_DIR)
+    """ Get the shared affidavit that can be used to sign files """
+    global _signing_uid, _signing_uid_timestamp
+    now = time.time()
+    if not _signing_uid or now - _signing_uid_timestamp > SIGNING_UID_TIMEOUT:
+        db = LvfsDatabase(os.environ)
+        db_users = LvfsDatabaseUsers(db)
+        _signing_uid = db_users.get_signing_uid()
+        _signing_uid_timestamp = now
+    return get_affidavit(_signing_uid, KEYRING_DIR, SIGCACHE_DIR)
+
+def ensure_embargo_metadata(basename):
+    """
+    Generates and signs the embargo metadata for a QA group the first time
+    it is requested, returning False if the file is not embargo metadata.
+    """
+    filename = os.path.join(DOWNLOAD_DIR, basename)
+
+    # both files are renamed into place only once complete
+    if os.path.exists(filename) and os.path.exists(filename + '.asc'):
+        return True
+
+    # not something we can generate
+    qa_group = metadata_qa_group_for_filename(basename)
+    if not qa_group:
+        return False
+
+    # only one process generates the files at a time
+    with metadata_lock_qa_group(qa_group) as locked:
+
+        # another process is still generating it
+        if not locked:
+            return os.path.exists(filename) and os.path.exists(filename + '.asc')
+
+        # another process generated it
+        if os.path.exists(filename) and os.path.exists(filename + '.asc'):
+            return True
+        db = LvfsDatabase(os.environ)
+        db_cache = LvfsDatabaseCache(db)
+        tmp = '%s.%i.%i.tmp' % (basename, os.getpid(), thread.get_ident())
+        for _ in range(3):
+            generation = metadata_get_generation(qa_group)
+            if not db_cache.to_file(filename + '.asc') or not db_cache.to_file(filename):
+                tmp_fn = metadata_update_qa_group(qa_group, tmp)[0]
+                try:
+                    create_affidavit().create_detached_many([tmp_fn])
+                    os.rename(tmp_fn + '.asc', filename + '.asc')
+                    os.rename(tmp_fn, filename)
+                finally:
+                    for fn in [tmp_fn, tmp_fn + '.asc']:
+                        if os.path.exists(fn):
+                            os.remove(fn)
+
+                # update database copy
+                db_cache.from_file(filename)
+                db_cache.from_file(filename + '.asc')
+
+            # the QA group was invalidated meanwhile, which may have happened
+            # before these files were in place for it to remove
+            if metadata_get_generation(qa_group) == generation:
+                return True
+            for fn in [filename, filename + '.asc']:
+                db_cache.delete(fn)
+                if os.path.exists(fn):
+                    os.remove(fn)
+    return False
 
 ################################################################################
 
+# the number of firmware objects shown on each page of the firmware list
+FIRMWARE_PAGE_SIZE = 50
+
 lvfs = Blueprint('lvfs', __name__, url_prefix='/lvfs', template_folder='templates/lvfs')
 
 @lvfs.errorhandler(401)
 def error_permission_denied(msg=None):
     """ Error handler: Permission Denied """
-    _event_log("Permission denied: %s" % msg, is_important=True)
+    # queued, so that lots of errors do not each wait for the database
+    _event_log("Permission denied: %s" % msg, is_important=True, sync=False)
     flash("Permission denied: %s" % msg)
     return render_template('error.html'), 401
 
 @lvfs.errorhandler(402)
 def error_internal(msg=None, errcode=402):
     """ Error handler: Internal """
-    _event_log("Internal error: %s" % msg, is_important=True)
+    _event_log("Internal error: %s" % msg, is_important=True, sync=False)
     flash("Internal error: %s" % msg)
     return render_template('error.html'), errcode
 
@@ -205,15 +299,13 @@ def device_list():
     try:
         db = LvfsDatabase(os.environ)
         db_firmware = LvfsDatabaseFirmware(db)
-        items = db_firmware.get_items()
+        items = db_firmware.get_items(target='stable')
     except CursorError as e:
         return error_internal(str(e))
 
     # get a sorted list of vendors
     vendors = []
     for item in items:
-        if item.target != 'stable':
-            continue
         vendor = item.mds[0].developer_name
         if vendor in vendors:
             continue
@@ -226,9 +318,6 @@ def device_list():
         html += '<h2>%s</h2>\n' % vendor
         html += '<ul>\n'
         for item in items:
-            if item.target != 'stable':
-                continue
-
             for md in item.mds:
 
                 # only show correct vendor
@@ -289,10 +378,10 @@ def upload():
     db_firmware = LvfsDatabaseFirmware(db)
     fwid = hashlib.sha1(data).hexdigest()
     try:
-        item = db_firmware.get_item(fwid)
+        exists = db_firmware.exists(fwid)
     except CursorError as e:
         return error_internal(str(e))
-    if item:
+    if exists:
         return error_internal("A firmware file with hash %s already exists" % fwid, 422)
 
     # parse the file
@@ -384,20 +473,18 @@ def upload():
                                   % (fw_version_inf, component.releases[0].version))
 
         # check the guid and version does not already exist
+        guid = component.provides[0].value
         try:
-            items = db_firmware.get_items()
+            fwid_existing = db_firmware.find_by_guid_version(guid, component.releases[0].version)
+            guid_existing = db_firmware.find_guid_for_cid(component.id, guid)
         except CursorError as e:
             return error_internal(str(e))
-        for item in items:
-            for md in item.mds:
-                if md.guid == component.provides[0].value and md.version == component.releases[0].version:
-                    return error_internal("A firmware file for this version already exists", 422)
+        if fwid_existing:
+            return error_internal("A firmware file for this version already exists", 422)
 
         # check the ID hasn't been reused by a different GUID
-        for item in items:
-            for md in item.mds:
-                if md.cid == component.id and not md.guid == component.provides[0].value:
-                    return error_internal("The %s ID has already been used by GUID %s" % (md.cid, md.guid), 422)
+        if guid_existing:
+            return error_internal("The %s ID has already been used by GUID %s" % (component.id, guid_existing), 422)
 
         # add to array
         apps.append(component)
@@ -520,8 +607,7 @@ def upload():
     try:
         filenames = []
         if target != 'private':
-            tmp = metadata_update_qa_group(fwobj.qa_group)
-            filenames.extend(tmp)
+            metadata_invalidate_qa_group(fwobj.qa_group)
         if target == 'stable':
             tmp = metadata_update_targets(['stable', 'testing'])
             filenames.extend(tmp)
@@ -531,8 +617,7 @@ def upload():
 
         # create detached signatures
         affidavit = create_affidavit()
-        for filename in filenames:
-            affidavit.create_detached(filename)
+        affidavit.create_detached_many(filenames)
 
         # update database copy
         db = LvfsDatabase(os.environ)
@@ -562,16 +647,29 @@ def firmware(show_all=False):
     if not _check_session():
         return redirect(url_for('.login'))
 
-    # get all firmware
+    # admin can see everything
+    qa_group = None
+    if session['username'] != 'admin':
+        qa_group = session['qa_group']
+
+    # get one page of firmware, and one more to know if there is another page
+    cursor = request.args.get('cursor')
     try:
         db = LvfsDatabase(os.environ)
         db_firmware = LvfsDatabaseFirmware(db)
-        items = db_firmware.get_items()
+        items = db_firmware.get_items(qa_group=qa_group,
+                                      limit=FIRMWARE_PAGE_SIZE + 1,
+                                      cursor=cursor,
+                                      latest_per_target=not show_all)
     except CursorError as e:
         return error_internal(str(e))
+    next_cursor = None
+    if len(items) > FIRMWARE_PAGE_SIZE:
+        items = items[:FIRMWARE_PAGE_SIZE]
+        next_cursor = items[-1].fwid
 
     # nothing!
-    if len(items) == 0:
+    if len(items) == 0 and not cursor:
         html = "<p>No firmware has been uploaded to the " \
                "&lsquo;%s&rsquo; QA group yet.</p>" % session['qa_group']
         return render_template('firmware.html', dyncontent=html)
@@ -579,10 +677,6 @@ def firmware(show_all=False):
     # group by the firmware name
     names = {}
     for item in items:
-        # admin can see everything
-        if session['username'] != 'admin':
-            if item.qa_group != session['qa_group']:
-                continue
         name = item.mds[0].name
         if not name in names:
             names[name] = []
@@ -607,17 +701,8 @@ def firmware(show_all=False):
         html += "<th></td>"
         html += "</tr>\n"
 
-        # by default we only show the first version of each target
-        targets_seen = {}
-
+        # by default the query only returns the first version of each target
         for item in names[name]:
-
-            # only show one
-            if item.target in targets_seen:
-                continue
-            if not show_all:
-                targets_seen[item.target] = item
-
             buttons = "<form method=\"get\" action=\"/lvfs/firmware/%s\">" \
                       "<button class=\"fixedwidth\">Details</button>" \
                       "</form>" % item.fwid
@@ -631,6 +716,14 @@ def firmware(show_all=False):
             html += "<td>%s</td>" % buttons
             html += '</tr>\n'
         html += "</table>"
+
+    # link to the next page
+    if next_cursor:
+        if show_all:
+            uri = url_for('.firmware_all', cursor=next_cursor)
+        else:
+            uri = url_for('.firmware', cursor=next_cursor)
+        html += "<p><a href=\"%s\">Older firmware &raquo;</a></p>" % uri
     return render_template('firmware.html', dyncontent=html)
 
 @lvfs.route('/firmware_all')
@@ -687,7 +780,8 @@ def firmware_delete_force(fwid):
 
     # update everything
     try:
-        filenames = metadata_update_qa_group(item.qa_group)
+        metadata_invalidate_qa_group(item.qa_group)
+        filenames = []
         if item.target == 'stable':
             tmp = metadata_update_targets(targets=['stable', 'testing'])
             filenames.extend(tmp)
@@ -697,8 +791,7 @@ def firmware_delete_force(fwid):
 
         # create detached signatures
         affidavit = create_affidavit()
-        for filename in filenames:
-            affidavit.create_detached(filename)
+        affidavit.create_detached_many(filenames)
     except NoKeyError as e:
         return error_internal('Failed to sign metadata: ' + str(e))
     except CursorError as e:
@@ -747,7 +840,8 @@ def firmware_promote(fwid, target):
 
     # update everything
     try:
-        filenames = metadata_update_qa_group(item.qa_group)
+        metadata_invalidate_qa_group(item.qa_group)
+        filenames = []
         if target == 'stable':
             tmp = metadata_update_targets(['stable', 'testing'])
             filenames.extend(tmp)
@@ -757,8 +851,7 @@ def firmware_promote(fwid, target):
 
         # create detached signatures
         affidavit = create_affidavit()
-        for filename in filenames:
-            affidavit.create_detached(filename)
+        affidavit.create_detached_many(filenames)
     except NoKeyError as e:
         return error_internal('Failed to sign metadata: ' + str(e))
     except CursorError as e:
@@ -828,8 +921,10 @@ def firmware_id(fwid):
         html += '<tr><th>Version (display only)</th><td>%s</td></tr>' % item.version_display
     db = LvfsDatabase(os.environ)
     db_clients = LvfsDatabaseClients(db)
-    cnt_fn = db_clients.get_firmware_count_filename(item.filename)
+    cnt_fn = db_clients.get_firmware_downloads(item.filename)
     html += '<tr><th>Downloads</th><td>%i</td></tr>' % cnt_fn
+    cnt_unique = db_clients.get_firmware_count_filename(item.filename)
+    html += '<tr><th>Unique Clients</th><td>~%i</td></tr>' % cnt_unique
     html += '<tr><th>Actions</th><td>%s</td></tr>' % buttons
     html += '</table>'
 
@@ -845,33 +940,7 @@ def firmware_id(fwid):
         html += '<tr><th>Download Size</th><td>%s</td></tr>' % sizeof_fmt(md.release_download_size)
         html += '</table>'
 
-    # show graph
-    db_clients = LvfsDatabaseClients(db)
-    data_fw = db_clients.get_stats_for_fn(12, 30, item.filename)
-    html += '<h1>User Downloads</h1>'
-    html += '<p>This graph will only show downloads since 2015-11-02.</p>'
-    html += '<canvas id="metadataChartMonths" width="800" height="400"></canvas>'
-    html += '<script>'
-    html += 'var ctx = document.getElementById("metadataChartMonths").getContext("2d");'
-    html += 'var data = {'
-    html += '    labels: %s,' % _get_chart_labels_months()[::-1]
-    html += '    datasets: ['
-    html += '        {'
-    html += '            label: "Firmware",'
-    html += '            fillColor: "rgba(251,14,5,0.2)",'
-    html += '            strokeColor: "rgba(151,14,5,0.1)",'
-    html += '            pointColor: "rgba(151,14,5,0.3)",'
-    html += '            pointStrokeColor: "#fff",'
-    html += '            pointHighlightFill: "#fff",'
-    html += '            pointHighlightStroke: "rgba(151,187,205,1)",'
-    html += '            data: %s' % data_fw[::-1]
-    html += '        },'
-    html += '    ]'
-    html += '};'
-    html += 'var myLineChartMonths = new Chart(ctx).Line(data, null);'
-    html += '</script>'
-
-    return render_template('firmware-details.html', dyncontent=html)
+    return render_template('firmware-details.html', dyncontent=html, fwid=fwid)
 
 @lvfs.route('/analytics')
 def analytics():
@@ -883,148 +952,135 @@ def analytics():
     if session['username'] != 'admin':
         return error_permission_denied('Unable to view analytics')
 
-    # add days
-    db = LvfsDatabase(os.environ)
-    db_clients = LvfsDatabaseClients(db)
-    data_md = db_clients.get_stats(30, 1, LvfsDownloadKind.METADATA)
-    data_fw = db_clients.get_stats(30, 1, LvfsDownloadKind.FIRMWARE)
-    data_asc = db_clients.get_stats(30, 1, LvfsDownloadKind.SIGNING)
-    html = '<h2>Metadata and Firmware Downloads (day)</h2>'
-    html += '<canvas id="metadataChartMonthsDays" width="800" height="400"></canvas>'
-    html += '<script>'
-    html += 'var ctx = document.getElementById("metadataChartMonthsDays").getContext("2d");'
-    html += 'var data = {'
-    html += '    labels: %s,' % _get_chart_labels_days()[::-1]
-    html += '    datasets: ['
-    html += '        {'
-    html += '            label: "Signing",'
-    html += '            fillColor: "rgba(120,120,120,0.15)",'
-    html += '            strokeColor: "rgba(120,120,120,0.15)",'
-    html += '            pointColor: "rgba(120,120,120,0.20)",'
-    html += '            pointStrokeColor: "#fff",'
-    html += '            pointHighlightFill: "#fff",'
-    html += '            pointHighlightStroke: "rgba(220,220,220,1)",'
-    html += '            data: %s' % data_asc[::-1]
-    html += '        },'
-    html += '        {'
-    html += '            label: "Metadata",'
-    html += '            fillColor: "rgba(20,120,220,0.2)",'
-    html += '            strokeColor: "rgba(20,120,120,0.1)",'
-    html += '            pointColor: "rgba(20,120,120,0.3)",'
-    html += '            pointStrokeColor: "#fff",'
-    html += '            pointHighlightFill: "#fff",'
-    html += '            pointHighlightStroke: "rgba(220,220,220,1)",'
-    html += '            data: %s' % data_md[::-1]
-    html += '        },'
-    html += '        {'
-    html += '            label: "Firmware",'
-    html += '            fillColor: "rgba(251,14,5,0.2)",'
-    html += '            strokeColor: "rgba(151,14,5,0.1)",'
-    html += '            pointColor: "rgba(151,14,5,0.3)",'
-    html += '            pointStrokeColor: "#fff",'
-    html += '            pointHighlightFill: "#fff",'
-    html += '            pointHighlightStroke: "rgba(151,187,205,1)",'
-    html += '            data: %s' % data_fw[::-1]
-    html += '        },'
-    html += '    ]'
-    html += '};'
-    html += 'var myLineChartDays = new Chart(ctx).Line(data, null);'
-    html += '</script>'
-
-    # add months
-    data_md = db_clients.get_metadata_by_month(LvfsDownloadKind.METADATA)
-    data_fw = db_clients.get_metadata_by_month(LvfsDownloadKind.FIRMWARE)
-    data_asc = db_clients.get_metadata_by_month(LvfsDownloadKind.SIGNING)
-    html += '<h2>Metadata and Firmware Downloads (month)</h2>'
-    html += '<canvas id="metadataChartMonths" width="800" height="400"></canvas>'
-    html += '<script>'
-    html += 'var ctx = document.getElementById("metadataChartMonths").getContext("2d");'
-    html += 'var data = {'
-    html += '    labels: %s,' % _get_chart_labels_months()[::-1]
-    html += '    datasets: ['
-    html += '        {'
-    html += '            label: "Signing",'
-    html += '            fillColor: "rgba(120,120,120,0.15)",'
-    html += '            strokeColor: "rgba(120,120,120,0.15)",'
-    html += '            pointColor: "rgba(120,120,120,0.20)",'
-    html += '            pointStrokeColor: "#fff",'
-    html += '            pointHighlightFill: "#fff",'
-    html += '            pointHighlightStroke: "rgba(220,220,220,1)",'
-    html += '            data: %s' % data_asc[::-1]
-    html += '        },'
-    html += '        {'
-    html += '            label: "Metadata",'
-    html += '            fillColor: "rgba(20,120,220,0.2)",'
-    html += '            strokeColor: "rgba(20,120,120,0.1)",'
-    html += '            pointColor: "rgba(20,120,120,0.3)",'
-    html += '            pointStrokeColor: "#fff",'
-    html += '            pointHighlightFill: "#fff",'
-    html += '            pointHighlightStroke: "rgba(220,220,220,1)",'
-    html += '            data: %s' % data_md[::-1]
-    html += '        },'
-    html += '        {'
-    html += '            label: "Firmware",'
-    html += '            fillColor: "rgba(251,14,5,0.2)",'
-    html += '            strokeColor: "rgba(151,14,5,0.1)",'
-    html += '            pointColor: "rgba(151,14,5,0.3)",'
-    html += '            pointStrokeColor: "#fff",'
-    html += '            pointHighlightFill: "#fff",'
-    html += '            pointHighlightStroke: "rgba(151,187,205,1)",'
-    html += '            data: %s' % data_fw[::-1]
-    html += '        },'
-    html += '    ]'
-    html += '};'
-    html += 'var myLineChartMonths = new Chart(ctx).Line(data, null);'
-    html += '</script>'
-
-    # add user agent
-    labels, data = db_clients.get_user_agent_stats()
-    html += '<h2>User Agents</h2>'
-    html += '<canvas id="metadataChartUserAgents" width="800" height="400"></canvas>'
-    html += '<script>'
-    html += 'var ctx = document.getElementById("metadataChartUserAgents").getContext("2d");'
-    html += 'var data = {'
-    html += '    labels: %s,' % _to_javascript_array(labels)
-    html += '    datasets: ['
-    html += '        {'
-    html += '            label: "User Agents",'
-    html += '            fillColor: "rgba(20,120,220,0.2)",'
-    html += '            strokeColor: "rgba(20,120,120,0.1)",'
-    html += '            pointColor: "rgba(20,120,120,0.3)",'
-    html += '            pointStrokeColor: "#fff",'
-    html += '            pointHighlightFill: "#fff",'
-    html += '            pointHighlightStroke: "rgba(220,220,220,1)",'
-    html += '            data: %s' % _to_javascript_array(data)
-    html += '        },'
-    html += '    ]'
-    html += '};'
-    html += 'var myLineChartUserAgent = new Chart(ctx).Bar(data, null);'
-    html += '</script>'
-
-    # add hours
-    data_md = db_clients.get_metadata_by_hour()
-    html += '<h2>Metadata and Firmware Downloads (hour)</h2>'
-    html += '<canvas id="metadataChartHours" width="800" height="400"></canvas>'
-    html += '<script>'
-    html += 'var ctx = document.getElementById("metadataChartHours").getContext("2d");'
-    html += 'var data = {'
-    html += '    labels: %s,' % _get_chart_labels_hours()
-    html += '    datasets: ['
-    html += '        {'
-    html += '            label: "Metadata",'
-    html += '            fillColor: "rgba(20,120,220,0.2)",'
-    html += '            strokeColor: "rgba(20,120,120,0.1)",'
-    html += '            pointColor: "rgba(20,120,120,0.3)",'
-    html += '            pointStrokeColor: "#fff",'
-    html += '            pointHighlightFill: "#fff",'
-    html += '            pointHighlightStroke: "rgba(220,220,220,1)",'
-    html += '            data: %s' % data_md
-    html += '        },'
-    html += '    ]'
-    html += '};'
-    html += 'var myLineChartHours = new Chart(ctx).Line(data, null);'
-    html += '</script>'
-    return render_template('analytics.html', dyncontent=html)
+    return render_template('analytics.html')
+
+def _get_analytics():
+    """ Gets the cached analytics data and the day it was calculated on """
+    analytics = analytics_cache.get()
+    now = datetime.datetime.strptime(analytics['date'], '%Y-%m-%d').date()
+    return (analytics, now)
+
+def _get_kind_series(data):
+    """ Gets the bucket values for each kind by name """
+    series = {}
+    for kind in _KIND_NAMES:
+        series[_KIND_NAMES[kind]] = data[kind]
+    return series
+
+@lvfs.route('/api/stats/downloads/days')
+def api_stats_downloads_days():
+    """ The number of downloads of each kind for the last 30 days """
+    if not _check_session() or session['username'] != 'admin':
+        return _json_error('Unable to view analytics', 403)
+    try:
+        analytics, now = _get_analytics()
+    except CursorError as e:
+        return _json_error(str(e), 500)
+    return _json_response(_get_series(_get_bucket_keys_days(now, 30),
+                                      _get_kind_series(analytics['days']),
+                                      request.args.get('since')))
+
+@lvfs.route('/api/stats/downloads/months')
+def api_stats_downloads_months():
+    """ The number of downloads of each kind for the last 12 months """
+    if not _check_session() or session['username'] != 'admin':
+        return _json_error('Unable to view analytics', 403)
+    try:
+        analytics, now = _get_analytics()
+    except CursorError as e:
+        return _json_error(str(e), 500)
+    return _json_response(_get_series(_get_bucket_keys_months(now),
+                                      _get_kind_series(analytics['months']),
+                                      request.args.get('since')))
+
+@lvfs.route('/api/stats/downloads/hours')
+def api_stats_downloads_hours():
+    """ The number of metadata downloads for each hour of the day """
+    if not _check_session() or session['username'] != 'admin':
+        return _json_error('Unable to view analytics', 403)
+    try:
+        analytics, now = _get_analytics()
+    except CursorError as e:
+        return _json_error(str(e), 500)
+
+    # these are not a time series, so since= does not apply
+    keys = []
+    for i in range(23, -1, -1):
+        keys.append('%02i' % i)
+    return _json_response(_get_series(keys, {'metadata': analytics['hours'][::-1]}))
+
+@lvfs.route('/api/stats/user_agents')
+def api_stats_user_agents():
+    """ The most common user agents this month """
+    if not _check_session() or session['username'] != 'admin':
+        return _json_error('Unable to view analytics', 403)
+    try:
+        analytics, now = _get_analytics()
+    except CursorError as e:
+        return _json_error(str(e), 500)
+    return _json_response(analytics['user_agents'])
+
+@lvfs.route('/api/stats/firmware/<fwid>')
+def api_stats_firmware(fwid):
+    """ The number of downloads of a firmware file for the last 12 months """
+    if not _check_session():
+        return _json_error('Not logged in', 403)
+    try:
+        db = LvfsDatabase(os.environ)
+        item = LvfsDatabaseFirmware(db).get_item(fwid)
+        if not item:
+            return _json_error('No firmware matched!', 404)
+        if item.qa_group != session['qa_group'] and session['username'] != 'admin':
+            return _json_error('Unable to view other vendor firmware', 403)
+        now = datetime.date.today()
+        data = LvfsDatabaseClients(db).get_stats_for_fn_by_month(item.filename)
+    except CursorError as e:
+        return _json_error(str(e), 500)
+    return _json_response(_get_series(_get_bucket_keys_months(now),
+                                      {'firmware': data},
+                                      request.args.get('since')))
+
+@lvfs.route('/livestats')
+def livestats():
+    """ Shows the current download rates """
+
+    # security check
+    if not _check_session():
+        return redirect(url_for('.login'))
+    if session['username'] != 'admin':
+        return error_permission_denied('Unable to view live stats')
+    return render_template('livestats.html')
+
+def _get_live_series(data, time_format, divisor):
+    """ Converts (timestamp, counts) rows into JSON buckets of rates """
+    buckets = []
+    for timestamp, counts in data:
+        bucket = {'key': time.strftime(time_format, time.localtime(timestamp))}
+        for kind in _KIND_NAMES:
+            bucket[_KIND_NAMES[kind]] = round(counts[kind] / float(divisor), 2)
+        buckets.append(bucket)
+    return {'size': len(buckets), 'since': None, 'buckets': buckets}
+
+@lvfs.route('/api/stats/live')
+def api_stats_live():
+    """ The downloads per second for the last 5 and up to 60 minutes """
+    if not _check_session() or session['username'] != 'admin':
+        return _json_error('Unable to view live stats', 403)
+    try:
+        minutes = min(max(int(request.args.get('minutes', 15)), 5), 60)
+    except ValueError:
+        return _json_error('Invalid minutes', 400)
+    try:
+        seconds, minutes = live_stats.get(300, minutes)
+    except (IOError, OSError) as e:
+        return _json_error(str(e), 500)
+
+    # the pool and recorder are only for the worker that answered
+    return _json_response({'seconds': _get_live_series(seconds, '%H:%M:%S', 1),
+                           'minutes': _get_live_series(minutes, '%H:%M', 60),
+                           'pool': get_pool_stats(),
+                           'recorder': download_recorder.get_stats(),
+                           'eventlog': eventlog_recorder.get_stats()})
 
 @lvfs.route('/login', methods=['GET', 'POST'])
 def login():
@@ -1069,10 +1125,27 @@ def logout():
     session.pop('username', None)
     return redirect(url_for('.index'))
 
+EVENTLOG_PAGE_SIZE = 20
+
+def _eventlog_items_html(items):
+    """ Gets the table rows for some event log items """
+    html = ''
+    for item in items:
+        html += '<tr>'
+        html += '<td class="history">%s</td>' % str(item.timestamp).split('.')[0]
+        html += '<td class="history">%s</td>' % item.address
+        html += '<td class="history">%s</td>' % item.username
+        if item.is_important == 1:
+            html += '<td class="history">&#x272a;</td>'
+        else:
+            html += '<td class="history"></td>'
+        html += '<td class="history">%s</td>' % item.message
+        html += '</tr>\n'
+    html += '</table>'
+    return html
+
 @lvfs.route('/eventlog')
-@lvfs.route('/eventlog/<start>')
-@lvfs.route('/eventlog/<start>/<length>')
-def eventlog(start=0, length=20):
+def eventlog():
     """
     Show an event log of user actions.
     """
@@ -1082,48 +1155,91 @@ def eventlog(start=0, length=20):
     if not session['qa_capability']:
         return error_permission_denied('Unable to show event log for non-QA user')
 
-    # get the page selection correct
+    # pages are found using the item IDs, so every page costs the same
+    try:
+        before = int(request.args.get('before', 0))
+        after = int(request.args.get('after', 0))
+    except ValueError:
+        return error_internal('Invalid event log page')
+    qa_group = None
+    if session['username'] != 'admin':
+        qa_group = session['qa_group']
     db = LvfsDatabase(os.environ)
     db_eventlog = LvfsDatabaseEventlog(db)
-    if session['username'] == 'admin':
-        eventlog_len = db_eventlog.size()
-    else:
-        eventlog_len = db_eventlog.size_for_qa_group(session['qa_group'])
-    nr_pages = int(math.ceil(eventlog_len / float(length)))
-
-    # table contents
-    html = ''
     try:
-        if session['username'] == 'admin':
-            items = db_eventlog.get_items(int(start), int(length))
+        if qa_group:
+            eventlog_len = db_eventlog.size_for_qa_group(qa_group)
         else:
-            items = db_eventlog.get_items_for_qa_group(session['qa_group'], int(start), int(length))
+            eventlog_len = db_eventlog.size()
+        items = db_eventlog.get_items(EVENTLOG_PAGE_SIZE, qa_group, before, after)
+
+        # going forward past the newest page shows the newest page
+        if after and len(items) < EVENTLOG_PAGE_SIZE:
+            after = 0
+            items = db_eventlog.get_items(EVENTLOG_PAGE_SIZE, qa_group)
     except CursorError as e:
         return error_internal(str(e))
     if len(items) == 0:
         return error_internal('No event log available!')
-    for item in items:
-        html += '<tr>'
-        html += '<td class="history">%s</td>' % str(item.timestamp).split('.')[0]
-        html += '<td class="history">%s</td>' % item.address
-        html += '<td class="history">%s</td>' % item.username
-        if item.is_important == 1:
-            html += '<td class="history">&#x272a;</td>'
-        else:
-            html += '<td class="history"></td>'
-        html += '<td class="history">%s</td>' % item.message
-        html += '</tr>\n'
-    html += '</table>'
 
-    # limit this to keep the UI sane
-    if nr_pages > 20:
-        nr_pages = 20
+    html = _eventlog_items_html(items)
+    html += '<p>%i events. ' % eventlog_len
+    if before or after:
+        html += '<a href="/lvfs/eventlog?after=%i">&laquo; Newer events</a> ' % items[0].id
+    if after or len(items) == EVENTLOG_PAGE_SIZE:
+        html += '<a href="/lvfs/eventlog?before=%i">Older events &raquo;</a>' % items[-1].id
+    html += '</p>'
+    return render_template('eventlog.html', dyncontent=html)
 
-    for i in range(nr_pages):
-        if int(start) == i * int(length):
-            html += '%i ' % (i + 1)
-        else:
-            html += '<a href="/lvfs/eventlog/%i/%s">%i</a> ' % (i * int(length), int(length), i + 1)
+@lvfs.route('/eventlog/search')
+def eventlog_search():
+    """
+    Search the event log by words in the message, user, address and date.
+    """
+    # security check
+    if not _check_session():
+        return redirect(url_for('.login'))
+    if not session['qa_capability']:
+        return error_permission_denied('Unable to show event log for non-QA user')
+
+    # dates are inclusive, so the end is the start of the next day
+    try:
+        start = None
+        end = None
+        if request.args.get('start'):
+            start = datetime.datetime.strptime(request.args['start'], '%Y-%m-%d')
+        if request.args.get('end'):
+            end = datetime.datetime.strptime(request.args['end'], '%Y-%m-%d')
+            end += datetime.timedelta(1)
+        before = int(request.args.get('before', 0))
+    except ValueError:
+        return error_internal('Invalid event log search')
+    qa_group = None
+    if session['username'] != 'admin':
+        qa_group = session['qa_group']
+    db = LvfsDatabase(os.environ)
+    db_eventlog = LvfsDatabaseEventlog(db)
+    try:
+        items = db_eventlog.search(EVENTLOG_PAGE_SIZE,
+                                   words=_get_words(request.args.get('q', '')),
+                                   username=request.args.get('username'),
+                                   addr=request.args.get('addr'),
+                                   start=start, end=end,
+                                   qa_group=qa_group, before=before)
+    except CursorError as e:
+        return error_internal(str(e))
+
+    html = _eventlog_items_html(items)
+    if not items:
+        html += '<p>No matching events.</p>'
+    elif len(items) == EVENTLOG_PAGE_SIZE:
+        args = []
+        for key, value in request.args.items(multi=True):
+            if key != 'before':
+                args.append((key, value.encode('utf-8')))
+        args.append(('before', items[-1].id))
+        html += '<p><a href="/lvfs/eventlog/search?%s">Older events &raquo;</a></p>' % \
+                cgi.escape(urllib.urlencode(args))
     return render_template('eventlog.html', dyncontent=html)
 
 def _update_metadata_from_fn(fwobj, fn):
@@ -1250,6 +1366,8 @@ def user_modify(username):
         db_users.update(session['username'], password, name, email, pubkey)
     except CursorError as e:
         return error_internal(str(e))
+    if session['username'] == 'admin':
+        _invalidate_signing_uid()
     #session['password'] = _password_hash(password)
     _event_log('Changed password')
     flash('Updated profile')
@@ -1385,10 +1503,8 @@ def usermod(username, key, value):
     # ensure we save the latest data
     msg = ensure_checkpoint()
     if msg:
-        db = LvfsDatabase(os.environ)
-        db_eventlog = LvfsDatabaseEventlog(db)
-        db_eventlog.add(msg, session['username'], 'admin',
-                        _get_client_address(), False)
+        record_event(msg, session['username'], 'admin',
+                     _get_client_address(), False)
 
 
     return redirect(url_for('.userlist'))
@@ -1560,23 +1676,24 @@ def metadata_rebuild():
         items = db_firmware.get_items()
     except CursorError as e:
         return error_internal(str(e))
+    items_by_fwid = {}
+    for fwobj in items:
+        items_by_fwid[fwobj.fwid] = fwobj
     for fn in glob.glob(os.path.join(UPLOAD_DIR, "*.cab")):
         fwupd = os.path.basename(fn).split('-')[0]
-        for fwobj in items:
-            if fwobj.fwid == fwupd:
-                err_page = _update_metadata_from_fn(fwobj, fn)
-                if err_page:
-                    return err_page
+        if fwupd in items_by_fwid:
+            err_page = _update_metadata_from_fn(items_by_fwid[fwupd], fn)
+            if err_page:
+                return err_page
 
     # update metadata
     try:
-        filenames = metadata_update_qa_group(None)
-        filenames.extend(metadata_update_targets(['stable', 'testing']))
+        metadata_invalidate_qa_group(None)
+        filenames = metadata_update_targets(['stable', 'testing'])
 
         # create detached signatures
         affidavit = create_affidavit()
-        for filename in filenames:
-            affidavit.create_detached(filename)
+        affidavit.create_detached_many(filenames)
 
         # update database copy
         db = LvfsDatabase(os.environ)
@@ -5,6 +5,13 @@
 # Licensed under the GNU General Public License Version 2
 
 import os
+import gzip
+import time
+import uuid
+import thread
+import threading
+import contextlib
+import MySQLdb as mdb
 import appstream
 
 from config import DOWNLOAD_DIR
@@ -12,22 +19,33 @@ from util import _qa_hash
 from db import LvfsDatabase, CursorError
 from db_eventlog import LvfsDatabaseEventlog
 from db_firmware import LvfsDatabaseFirmware
+from db_cache import LvfsDatabaseCache
+
+def _write_store(store, filename):
+    """ Saves the store so the same metadata always has the same bytes """
+
+    # Store.to_file() puts the mtime and filename in the gzip header, which
+    # would stop the signature cache ever matching regenerated metadata
+    tmp = '%s.%i.%i.tmp' % (filename, os.getpid(), thread.get_ident())
+    with open(tmp, 'wb') as raw:
+        f = gzip.GzipFile(filename='', mode='wb', fileobj=raw, mtime=0)
+        try:
+            f.write(store.to_xml().encode('utf-8'))
+        finally:
+            f.close()
+    os.rename(tmp, filename)
 
 def _generate_metadata_kind(filename, targets=None, qa_group=None):
     """ Generates AppStream metadata of a specific kind """
     db = LvfsDatabase(os.environ)
     db_firmware = LvfsDatabaseFirmware(db)
-    items = db_firmware.get_items()
+    items = db_firmware.get_items(qa_group=qa_group, target=targets)
     store = appstream.Store('lvfs')
     for item in items:
 
         # filter
         if item.target == 'private':
             continue
-        if targets and item.target not in targets:
-            continue
-        if qa_group and qa_group != item.qa_group:
-            continue
 
         # add each component
         for md in item.mds:
@@ -86,30 +104,114 @@ def _generate_metadata_kind(filename, targets=None, qa_group=None):
     if not os.path.exists(DOWNLOAD_DIR):
         os.mkdir(DOWNLOAD_DIR)
     filename = os.path.join(DOWNLOAD_DIR, filename)
-    store.to_file(filename)
+    _write_store(store, filename)
     return filename
 
-def metadata_update_qa_group(qa_group):
-    """ updates metadata for a specific qa_group """
-
-    # explicit
-    if qa_group:
+def metadata_update_qa_group(qa_group, filename=None):
+    """ updates metadata for a specific qa_group, optionally to another filename """
+    assert qa_group
+    if not filename:
         filename = 'firmware-%s.xml.gz' % _qa_hash(qa_group)
-        _generate_metadata_kind(filename, qa_group=qa_group)
-        return [os.path.join(DOWNLOAD_DIR, filename)]
+    _generate_metadata_kind(filename, qa_group=qa_group)
+    return [os.path.join(DOWNLOAD_DIR, filename)]
+
+@contextlib.contextmanager
+def metadata_lock_qa_group(qa_group, timeout=60):
+    """
+    Holds the lock used by every process while generating the metadata for
+    a qa_group, yielding False if it could not be taken
+    """
+    name = 'lvfs_embargo_%s' % _qa_hash(qa_group)
+    db = LvfsDatabase(os.environ)
+    cur = None
+    try:
+        cur = db.cursor()
+        cur.execute("SELECT GET_LOCK(%s, %s);", (name, timeout,))
+        locked = cur.fetchone()[0] == 1
+    except mdb.Error, e:
+        raise CursorError(cur, e)
+    try:
+        yield locked
+    finally:
+        if locked:
+            cur.execute("SELECT RELEASE_LOCK(%s);", (name,))
+
+def metadata_get_generation(qa_group):
+    """ gets the marker that changes every time the qa_group is invalidated """
+    db = LvfsDatabase(os.environ)
+    name = 'firmware-%s.generation' % _qa_hash(qa_group)
+    return LvfsDatabaseCache(db).get_data(name)[0]
+
+def metadata_invalidate_qa_group(qa_group):
+    """ removes the metadata for a qa_group so it is regenerated on demand """
 
     # do for all
     db = LvfsDatabase(os.environ)
-    db_firmware = LvfsDatabaseFirmware(db)
-    qa_groups = db_firmware.get_qa_groups()
+    if qa_group:
+        qa_groups = [qa_group]
+    else:
+        db_firmware = LvfsDatabaseFirmware(db)
+        qa_groups = db_firmware.get_qa_groups()
+    if not qa_groups:
+        return
+
+    # a new group can be generated without waiting for the next lookup
+    with _qa_group_hashes_lock:
+        for qa_group in qa_groups:
+            _qa_group_hashes[_qa_hash(qa_group)] = qa_group
+
+    # a generation running now sees the new marker and removes its result, so
+    # no lock is needed; the database copy goes first so that it cannot be
+    # copied back to disk after the local file is removed
+    generations = []
     filenames = []
     for qa_group in qa_groups:
-        filename_qa = 'firmware-%s.xml.gz' % _qa_hash(qa_group)
-        filename = _generate_metadata_kind(filename_qa, qa_group=qa_group)
-        filenames.append(filename)
-
-    # return all the files we have to sign
-    return filenames
+        generations.append(('firmware-%s.generation' % _qa_hash(qa_group),
+                            uuid.uuid4().hex))
+        filename = 'firmware-%s.xml.gz' % _qa_hash(qa_group)
+        filenames.extend([filename, filename + '.asc'])
+    try:
+        cur = db.cursor()
+        cur.executemany("REPLACE INTO cache(filename,data) VALUES(%s,%s);", generations)
+        cur.execute("DELETE FROM cache WHERE filename IN (" +
+                    ",".join(["%s"] * len(filenames)) + ");", filenames)
+    except mdb.Error, e:
+        raise CursorError(cur, e)
+    for fn in filenames:
+        path = os.path.join(DOWNLOAD_DIR, fn)
+        if os.path.exists(path):
+            os.remove(path)
+
+# hash -> qa_group, looked up again at most every QA_GROUP_HASHES_TIMEOUT seconds
+_qa_group_hashes = {}
+_qa_group_hashes_timestamp = 0
+_qa_group_hashes_lock = threading.Lock()
+QA_GROUP_HASHES_TIMEOUT = 60
+
+def metadata_qa_group_for_filename(basename):
+    """ gets the qa_group for a metadata filename, or None """
+
+    # the hash is always 40 chars, so this skips firmware-testing.xml.gz
+    if not basename.startswith('firmware-') or not basename.endswith('.xml.gz'):
+        return None
+    if len(basename) != len('firmware-.xml.gz') + 40:
+        return None
+
+    # find the QA group that hashes to the same value, only looking at the
+    # database again for an unknown hash every so often
+    global _qa_group_hashes_timestamp
+    digest = basename[len('firmware-'):-len('.xml.gz')]
+    with _qa_group_hashes_lock:
+        now = time.time()
+        if not digest in _qa_group_hashes and \
+                now - _qa_group_hashes_timestamp > QA_GROUP_HASHES_TIMEOUT:
+            db = LvfsDatabase(os.environ)
+            db_firmware = LvfsDatabaseFirmware(db)
+            _qa_group_hashes.clear()
+            for qa_group in db_firmware.get_qa_groups():
+                _qa_group_hashes[_qa_hash(qa_group)] = qa_group
+            _qa_group_hashes_timestamp = now
+        return _qa_group_hashes.get(digest)
 
 def metadata_update_targets(targets):
     """ updates metadata for a specific target """
@@ -0,0 +1,150 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Richard Hughes <richard@hughsie.com>
+# Licensed under the GNU General Public License Version 2
+#
+# Moves old rows from the clients table into compressed monthly archives.
+#
+# MySQL partitioning by month was not used as every unique key has to
+# include the partitioning column, and clients has UNIQUE KEY id (id).
+# Dropping that key would also stop the archives being loaded back in
+# without duplicates.
+
+import os
+import sys
+import csv
+import gzip
+import datetime
+import MySQLdb as mdb
+
+from config import ARCHIVE_DIR, CLIENTS_RETENTION_DAYS
+from db import LvfsDatabase, CursorError
+from db_clients import _rebuild_rollups, _rebuild_sketches
+
+# deleting in chunks keeps each statement, and the undo log, small
+DELETE_CHUNK_SIZE = 10000
+
+def _get_archive_filename(day):
+    """ Gets the archive file for the month a day is in """
+    return os.path.join(ARCHIVE_DIR, 'clients-' + day.strftime('%Y-%m') + '.csv.gz')
+
+def _encode(value):
+    """ Converts a column value into something the csv module can write """
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def _archive_day(cur, day):
+    """ Appends the raw rows for one day to the monthly archive, then deletes them """
+    end = day + datetime.timedelta(1)
+
+    # the aggregates must cover the rows before they are removed
+    _rebuild_rollups(cur, day, end)
+    _rebuild_sketches(cur, day, end)
+
+    cur.execute("SELECT c.id, c.timestamp, c.addr, c.is_firmware, c.filename, "
+                "ua.user_agent FROM clients c "
+                "LEFT JOIN user_agents ua ON ua.id = c.user_agent_id "
+                "WHERE c.timestamp >= %s AND c.timestamp < %s ORDER BY c.id;",
+                (day, end,))
+    rows = cur.fetchall()
+    if not rows:
+        return 0
+
+    # each run appends a new gzip member, which gzip.open() reads as one stream
+    with open(_get_archive_filename(day), 'ab') as raw:
+        f = gzip.GzipFile(fileobj=raw, mode='wb')
+        writer = csv.writer(f)
+        for row in rows:
+            writer.writerow([_encode(value) for value in row])
+        f.close()
+        raw.flush()
+        os.fsync(raw.fileno())
+
+    # only delete what was written, and all of it or nothing so that the
+    # rollups are never rebuilt from a partly deleted day
+    max_id = rows[-1][0]
+    cur.execute("START TRANSACTION;")
+    try:
+        while True:
+            cur.execute("DELETE FROM clients WHERE timestamp >= %s AND timestamp < %s "
+                        "AND id <= %s LIMIT %s;", (day, end, max_id, DELETE_CHUNK_SIZE,))
+            if cur.rowcount < DELETE_CHUNK_SIZE:
+                break
+        cur.execute("COMMIT;")
+    except mdb.Error:
+        cur.execute("ROLLBACK;")
+        raise
+    return len(rows)
+
+def archive_clients(retention_days=CLIENTS_RETENTION_DAYS):
+    """ Archives all the rows older than the retention window, returning the count """
+    if not os.path.exists(ARCHIVE_DIR):
+        os.mkdir(ARCHIVE_DIR)
+    cutoff = datetime.date.today() - datetime.timedelta(retention_days)
+    db = LvfsDatabase(os.environ)
+    cnt = 0
+    try:
+        cur = db.cursor()
+        cur.execute("SELECT DATE(MIN(timestamp)) FROM clients;")
+        day = cur.fetchone()[0]
+        while day and day < cutoff:
+            cnt += _archive_day(cur, day)
+            day += datetime.timedelta(1)
+    except mdb.Error, e:
+        raise CursorError(cur, e)
+    return cnt
+
+def rehydrate_month(month):
+    """ Loads an archived month, e.g. '2015-06', into the clients_archive table """
+    filename = _get_archive_filename(datetime.datetime.strptime(month, '%Y-%m'))
+    db = LvfsDatabase(os.environ)
+    cnt = 0
+    try:
+        cur = db.cursor()
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS clients_archive (
+              id INT NOT NULL,
+              timestamp TIMESTAMP NULL DEFAULT NULL,
+              addr VARCHAR(40) DEFAULT NULL,
+              is_firmware TINYINT DEFAULT 0,
+              filename VARCHAR(256) DEFAULT NULL,
+              user_agent VARCHAR(256) DEFAULT NULL,
+              UNIQUE KEY id (id),
+              KEY timestamp (timestamp)
+            ) CHARSET=utf8;
+        """)
+        rows = []
+        with gzip.open(filename, 'rb') as f:
+            for row in csv.reader(f):
+                rows.append([value.decode('utf-8') or None for value in row])
+                if len(rows) == 1000:
+                    cur.executemany("INSERT IGNORE INTO clients_archive "
+                                    "VALUES (%s, %s, %s, %s, %s, %s);", rows)
+                    cnt += len(rows)
+                    rows = []
+        if rows:
+            cur.executemany("INSERT IGNORE INTO clients_archive "
+                            "VALUES (%s, %s, %s, %s, %s, %s);", rows)
+            cnt += len(rows)
+    except mdb.Error, e:
+        raise CursorError(cur, e)
+    return cnt
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == 'rehydrate':
+        cnt = rehydrate_month(sys.argv[2])
+        print 'Loaded %i rows into clients_archive' % cnt
+        return 0
+    if len(sys.argv) != 1:
+        print 'Usage: %s [rehydrate YYYY-MM]' % sys.argv[0]
+        return 1
+    cnt = archive_clients()
+    print 'Archived %i rows older than %i days' % (cnt, CLIENTS_RETENTION_DAYS)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
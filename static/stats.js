@@ -0,0 +1,89 @@
+/* Copyright (C) 2015 Richard Hughes <richard@hughsie.com>
+ * Licensed under the GNU General Public License Version 2
+ *
+ * Loads the statistics from /lvfs/api/stats and draws them using Chart.js.
+ * Series are kept in localStorage so that only the newest buckets are
+ * requested again; the last bucket is always fetched as it may still be
+ * counting.
+ */
+
+function lvfsLoadJson(url, cb) {
+    var req = new XMLHttpRequest();
+    req.open('GET', url);
+    req.onload = function() {
+        if (req.status == 200)
+            cb(JSON.parse(req.responseText));
+    };
+    req.send();
+}
+
+function lvfsLoadSeries(url, cb) {
+    var cached = null;
+    try {
+        cached = JSON.parse(window.localStorage.getItem(url));
+    } catch (e) {
+    }
+    if (!cached || cached.buckets.length == 0) {
+        lvfsLoadJson(url, function(data) {
+            window.localStorage.setItem(url, JSON.stringify(data));
+            cb(data);
+        });
+        return;
+    }
+    var since = cached.buckets[cached.buckets.length - 1].key;
+    lvfsLoadJson(url + '?since=' + since, function(data) {
+        var buckets = [];
+        for (var i = 0; i < cached.buckets.length; i++) {
+            if (cached.buckets[i].key < since)
+                buckets.push(cached.buckets[i]);
+        }
+        buckets = buckets.concat(data.buckets);
+        data.buckets = buckets.slice(Math.max(0, buckets.length - data.size));
+        window.localStorage.setItem(url, JSON.stringify(data));
+        cb(data);
+    });
+}
+
+var lvfsColors = {
+    signing: ['rgba(120,120,120,0.15)', 'rgba(120,120,120,0.15)', 'rgba(120,120,120,0.20)'],
+    metadata: ['rgba(20,120,220,0.2)', 'rgba(20,120,120,0.1)', 'rgba(20,120,120,0.3)'],
+    firmware: ['rgba(251,14,5,0.2)', 'rgba(151,14,5,0.1)', 'rgba(151,14,5,0.3)']
+};
+
+function lvfsDrawSeries(id, data, names, labels) {
+    var chart = {labels: [], datasets: []};
+    for (var i = 0; i < data.buckets.length; i++)
+        chart.labels.push(data.buckets[i].key);
+    for (var j = 0; j < names.length; j++) {
+        var values = [];
+        for (var i = 0; i < data.buckets.length; i++)
+            values.push(data.buckets[i][names[j]]);
+        chart.datasets.push({
+            label: labels[j],
+            fillColor: lvfsColors[names[j]][0],
+            strokeColor: lvfsColors[names[j]][1],
+            pointColor: lvfsColors[names[j]][2],
+            pointStrokeColor: '#fff',
+            pointHighlightFill: '#fff',
+            pointHighlightStroke: 'rgba(220,220,220,1)',
+            data: values
+        });
+    }
+    var ctx = document.getElementById(id).getContext('2d');
+    return new Chart(ctx).Line(chart, null);
+}
+
+function lvfsDrawBar(id, label, labels, values) {
+    var chart = {labels: labels, datasets: [{
+        label: label,
+        fillColor: lvfsColors.metadata[0],
+        strokeColor: lvfsColors.metadata[1],
+        pointColor: lvfsColors.metadata[2],
+        pointStrokeColor: '#fff',
+        pointHighlightFill: '#fff',
+        pointHighlightStroke: 'rgba(220,220,220,1)',
+        data: values
+    }]};
+    var ctx = document.getElementById(id).getContext('2d');
+    new Chart(ctx).Bar(chart, null);
+}
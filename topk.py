@@ -0,0 +1,64 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Richard Hughes <richard@hughsie.com>
+# Licensed under the GNU General Public License Version 2
+
+import json
+
+class SpaceSaving(object):
+    """
+    Tracks the most frequent items in a stream using a fixed amount of memory.
+
+    Any item seen more than total/capacity times is guaranteed to be kept,
+    and each count is at most the value in errors too high.
+    """
+
+    def __init__(self, capacity=100):
+        """ Constructor for object """
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+
+    def add(self, item, count=1):
+        """ Adds an item to the summary """
+        if item in self.counts:
+            self.counts[item] += count
+            return
+
+        # replace the least frequent item, which gives the new one its count
+        error = 0
+        if len(self.counts) >= self.capacity:
+            victim = min(self.counts, key=self.counts.get)
+            error = self.counts.pop(victim)
+            self.errors.pop(victim)
+        self.counts[item] = count + error
+        self.errors[item] = error
+
+    def merge(self, other):
+        """ Adds all the items from another summary """
+        for item in other.counts:
+            self.add(item, other.counts[item])
+            self.errors[item] += other.errors[item]
+
+    def top(self, n):
+        """ Returns the n most frequent (item, count) pairs """
+        items = sorted(self.counts.items(), key=lambda x: x[1], reverse=True)
+        return items[0:n]
+
+    def to_blob(self):
+        """ Exports the summary in a compact form """
+        items = []
+        for item in self.counts:
+            items.append([item, self.counts[item], self.errors[item]])
+        return json.dumps({'capacity': self.capacity, 'items': items})
+
+    @staticmethod
+    def from_blob(blob):
+        """ Imports a summary exported using to_blob() """
+        data = json.loads(blob)
+        summary = SpaceSaving(data['capacity'])
+        for item, count, error in data['items']:
+            summary.counts[item] = count
+            summary.errors[item] = error
+        return summary